@@ -1,6 +1,7 @@
 import logging
-from blacksheep.classes import qValues, OutlierTable
-from blacksheep.deva import make_outliers_table, compare_groups_outliers, deva
+from blacksheep.classes import qValues, OutlierTable, OrderedOutlierTable
+from blacksheep.deva import make_outliers_table, recall_outliers, compare_groups_outliers, deva
+from blacksheep.deva import jackknife_qvalues
 from blacksheep.visualization import plot_heatmap
 from blacksheep.simulate import run_simulations
 from blacksheep.parsers import (
@@ -8,6 +9,7 @@ from blacksheep.parsers import (
     normalize,
     read_in_values,
     read_in_outliers,
+    read_in_row_stats,
 )
 
 
@@ -17,14 +19,18 @@ logging.captureWarnings(True)
 
 __all__ = [
     "make_outliers_table",
+    "recall_outliers",
     "compare_groups_outliers",
     "deva",
+    "jackknife_qvalues",
     "plot_heatmap",
     "run_simulations",
     "binarize_annotations",
     "normalize",
     "read_in_values",
     "read_in_outliers",
+    "read_in_row_stats",
     "qValues",
-    "OutlierTable"
+    "OutlierTable",
+    "OrderedOutlierTable",
 ]
@@ -8,10 +8,19 @@ row_iqr_name = "row_iqr"
 row_median_name = "row_median"
 row_upper_bound_name = "row_medPlus"
 row_lower_bound_name = "row_medMinus"
+row_uncertain_name = "row_uncertainCalls"
+row_hash_name = "row_hash"
 col_seps = "_"
 col_not_outlier_suffix = "notOutliers"
 col_outlier_suffix = "outliers"
 agg_col = "gene"
+both_directions = "both"
+directions = ["up", "down"]
+count_dtype = "int32"
+value_dtypes = ["float64", "float32"]
+backend_env_var = "BLACKSHEEP_BACKEND"
+backends = ["numpy", "numba"]
+auto_backend = "auto"
 
 
 # Used primarily in comparisons
@@ -20,6 +29,7 @@ not_outlier_count_lab = "NotOutlier"
 fisherp_col = "fisherp"
 fisherfdr_col = "fisherFDR"
 mult_hypoth_method = "fdr_bh"
+comparison_tests = ["fisher", "permutation"]
 
 
 # Used in outliers
@@ -29,6 +39,8 @@ general_group_label_1 = "1"
 comp_group_suffix = "_%s_%s"
 general_fisher_p = "fisherp"
 specific_fisher_p = "fisherp_%s_%s"
+jackknife_max_col = "%s_jackknifeMax"  # % fdr_col
+jackknife_se_col = "%s_jackknifeSE"  # % fdr_col
 
 
 # Used in visualization
@@ -41,7 +53,10 @@ plot_title = "Outliers in %s"
 gene_list_file_name = "%s.%s.sig_genes.fdr%s.txt"
 frac_table_file_name = "%s.%s.fraction_table.tsv"
 outlier_table_file_name = "%s.%s.count_table.tsv"
+row_stats_file_name = "%s.row_stats.tsv"
+manifest_file_name = "%s.manifest.tsv"
 ind_comparison_file_name = "%s.%s.%s.qvalues.tsv"
 qvalues_file_name = "%s.%s.qvalues.tsv"
+iqrs_prefix = "%s.iqrs%s"  # % (output_prefix, iqrs)
 figure_file_name = "%s.%s.fdr%s.heatmap.pdf"
 parameters_file_name = "%s.parameters.txt"
@@ -0,0 +1,133 @@
+import math
+import os
+from typing import Optional
+import numpy as np
+from blacksheep._constants import *
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _get_backend(backend: Optional[str] = None) -> str:
+    """Picks the backend for the row statistics, outlier calls, aggregation and fisher tests.
+
+    Args:
+        backend: "numpy", "numba" or "auto". If None, the BLACKSHEEP_BACKEND environment \
+        variable is used, and "auto" if that is not set. "auto" uses numba when it is installed.
+
+    Returns: "numpy" or "numba"
+
+    """
+    if backend is None:
+        backend = os.environ.get(backend_env_var, auto_backend)
+    if backend == auto_backend:
+        return "numba" if numba is not None else "numpy"
+    if backend not in backends:
+        raise ValueError("backend must be one of %s" % ", ".join(backends + [auto_backend]))
+    if backend == "numba" and numba is None:
+        raise ImportError("The numba backend needs numba to be installed")
+    return backend
+
+
+def _jit(func):
+    """Compiles a kernel with numba when it is installed. Kernels are only compiled when they
+    are first called."""
+    if numba is None:
+        return func
+    return numba.njit(nogil=True, cache=True)(func)
+
+
+@_jit
+def _sorted_quantile(ordered, q):
+    """Quantile of a sorted 1D array, interpolated the same way as numpy's quantile functions so
+    results are identical to _row_quantiles."""
+    last = len(ordered) - 1
+    virtual = last * q
+    previous = int(math.floor(virtual))
+    following = min(previous + 1, last)
+    gamma = virtual - previous
+    a, b = ordered[previous], ordered[following]
+    diff_b_a = b - a
+    if gamma >= 0.5:
+        return b - diff_b_a * (1 - gamma)
+    return a + diff_b_a * gamma
+
+
+@_jit
+def _row_stats_kernel(values):
+    """Median and IQR of each row, ignoring missing values. Equivalent to _calculate_row_stats.
+    """
+    n_rows, n_cols = values.shape
+    row_median = np.full(n_rows, np.nan)
+    row_iqr = np.full(n_rows, np.nan)
+    packed = np.empty(n_cols, dtype=values.dtype)
+    for i in range(n_rows):
+        n_valid = 0
+        for j in range(n_cols):
+            if not np.isnan(values[i, j]):
+                packed[n_valid] = values[i, j]
+                n_valid += 1
+        if n_valid == 0:
+            continue
+        ordered = np.sort(packed[:n_valid])
+        row_median[i] = _sorted_quantile(ordered, 0.5)
+        row_iqr[i] = _sorted_quantile(ordered, 0.75) - _sorted_quantile(ordered, 0.25)
+    return row_median, row_iqr
+
+
+@_jit
+def _outlier_mask_kernel(values, bound, up):
+    """Compares each value to the outlier bound of its row. Equivalent to _call_outliers."""
+    n_rows, n_cols = values.shape
+    outlier_mask = np.zeros((n_rows, n_cols), dtype=np.bool_)
+    for i in range(n_rows):
+        for j in range(n_cols):
+            if up:
+                outlier_mask[i, j] = values[i, j] > bound[i]
+            else:
+                outlier_mask[i, j] = values[i, j] < bound[i]
+    return outlier_mask
+
+
+@_jit
+def _aggregate_kernel(mask, group_codes, counts):
+    """Adds the rows of a boolean mask into the rows of counts given by group_codes."""
+    for i in range(mask.shape[0]):
+        group = group_codes[i]
+        for j in range(mask.shape[1]):
+            if mask[i, j]:
+                counts[group, j] += 1
+    return counts
+
+
+@_jit
+def _log_choose(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+@_jit
+def _fisher_kernel(outliers0, outliers1, not_outliers0, not_outliers1):
+    """Two-sided fisher exact test p-values for the 2x2 tables of each row, from signed integer
+    counts. Tables are summed over every table at least as unlikely as the observed one, with
+    the relative tolerance for ties of _fisher.tie_tolerance."""
+    pvalues = np.ones(len(outliers0))
+    for i in range(len(outliers0)):
+        a, b, c, d = outliers0[i], outliers1[i], not_outliers0[i], not_outliers1[i]
+        n1, n2, n = a + b, c + d, a + c
+        if n1 == 0 or n2 == 0 or n == 0 or b + d == 0:
+            continue
+        total = n1 + n2
+        log_denominator = _log_choose(total, n)
+        log_pexact = _log_choose(n1, a) + _log_choose(n2, n - a) - log_denominator
+        # Same as _fisher.tie_tolerance, which is wider than the rounding error of lgamma
+        cutoff = log_pexact + math.log1p(1e-7)
+        pvalue = 0.0
+        for x in range(max(0, n - n2), min(n, n1) + 1):
+            log_p = _log_choose(n1, x) + _log_choose(n2, n - x) - log_denominator
+            if log_p <= cutoff:
+                pvalue += math.exp(log_p)
+        pvalues[i] = min(pvalue, 1.0)
+    return pvalues
+
@@ -1,17 +1,178 @@
 import pandas as pd
 import numpy as np
-import scipy.stats
 from pandas import DataFrame
-from typing import List
+from typing import List, Tuple
 from blacksheep._constants import *
+from blacksheep import _jit
 
 
 SampleList = List[str]
+RowQuantiles = Tuple[np.ndarray, np.ndarray, np.ndarray]
+popcount_table = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+def _lerp(a: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """Linear interpolation between a and b, computed the same way as numpy's quantile
+    functions so results are identical to np.nanquantile.
+
+    Args:
+        a: Lower order statistic.
+        b: Upper order statistic.
+        t: Fraction of the way from a to b.
+
+    Returns:
+        Interpolated values.
+
+    """
+    diff_b_a = b - a
+    return np.where(t >= 0.5, b - diff_b_a * (1 - t), a + diff_b_a * t)
+
+
+def _dense_row_quantiles(values: np.ndarray) -> RowQuantiles:
+    """Calculates the first quartile, median and third quartile of each row of an array without
+    missing values. Every row has the same number of values, so each quantile is read from the
+    same columns of the ordered rows.
+
+    Args:
+        values: 2D array without missing values, rows as sites/genes and columns as samples.
+
+    Returns:
+        Arrays with the first quartile, median and third quartile of each row.
+
+    """
+    ordered = np.sort(values, axis=1)
+    last = values.shape[1] - 1
+
+    quantiles = []
+    for q in (0.25, 0.5, 0.75):
+        virtual = last * q
+        previous = int(np.floor(virtual))
+        following = min(previous + 1, last)
+        gamma = np.full(len(values), virtual - previous)
+        quantiles.append(_lerp(ordered[:, previous], ordered[:, following], gamma))
+    return quantiles[0], quantiles[1], quantiles[2]
+
+
+def _row_quantiles(values: np.ndarray) -> RowQuantiles:
+    """Calculates the first quartile, median and third quartile of each row, ignoring missing
+    values. Each row is ordered once and all three quantiles are read from that ordering.
+    Ordering puts missing values last, so the non-missing values of each row are packed at the
+    start and quantile positions only depend on how many there are. Tables are first checked
+    for any missing value, and tables without any skip counting them per row.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+
+    Returns:
+        Arrays with the first quartile, median and third quartile of each row. Rows without any
+        values are NaN.
+
+    """
+    if values.shape[1] > 0 and not np.isnan(values).any():
+        return _dense_row_quantiles(values)
+
+    valid_counts = (~np.isnan(values)).sum(axis=1)
+    ordered = np.sort(values, axis=1)
+    no_values = valid_counts == 0
+    last = np.maximum(valid_counts - 1, 0)
+    rows = np.arange(len(values))
+
+    quantiles = []
+    for q in (0.25, 0.5, 0.75):
+        virtual = last * q
+        previous = np.floor(virtual).astype(np.intp)
+        following = np.minimum(previous + 1, last)
+        gamma = virtual - previous
+        quantile = _lerp(ordered[rows, previous], ordered[rows, following], gamma)
+        quantile[no_values] = np.nan
+        quantiles.append(quantile)
+    return quantiles[0], quantiles[1], quantiles[2]
+
+
+def _calculate_row_stats(
+    values: np.ndarray, backend: str = "numpy"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculates the median and inter-quartile range (IQR) of each row, ignoring missing values.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+        backend: "numpy" or "numba", from _get_backend. Both give identical results.
+
+    Returns:
+        Arrays with the median and IQR of each row.
+
+    """
+    if backend == "numba":
+        return _jit._row_stats_kernel(np.ascontiguousarray(values))
+    q1, row_median, q3 = _row_quantiles(values)
+    return row_median, q3 - q1
+
+
+def _make_row_stats(
+    index: pd.Index, row_median: np.ndarray, row_iqr: np.ndarray, num_iqrs: float
+) -> DataFrame:
+    """Collects the statistics used to call outliers in each row.
+
+    Args:
+        index: Row identifiers of the values table.
+        row_median: Median of each row.
+        row_iqr: IQR of each row.
+        num_iqrs: How many IQRs above or below the median the outlier bounds are.
+
+    Returns:
+        DataFrame with the median, IQR, upper bound and lower bound of each row.
+
+    """
+    return DataFrame(
+        {
+            row_median_name: row_median,
+            row_iqr_name: row_iqr,
+            row_upper_bound_name: row_median + (num_iqrs * row_iqr),
+            row_lower_bound_name: row_median - (num_iqrs * row_iqr),
+        },
+        index=index,
+    )
+
+
+def _call_outliers(
+    values: np.ndarray,
+    row_median: np.ndarray,
+    row_iqr: np.ndarray,
+    num_iqrs: float,
+    up_or_down: str,
+    backend: str = "numpy",
+) -> np.ndarray:
+    """Compares each value to the outlier bound of its row.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+        row_median: Median of each row.
+        row_iqr: IQR of each row.
+        num_iqrs: How many IQRs above or below the median to consider something an outlier.
+        up_or_down: Whether to call outliers above the median (up) or below the median (down)
+        backend: "numpy" or "numba", from _get_backend. Both give identical results.
+
+    Returns:
+        A boolean array that is True where a value is an outlier.
+
+    """
+    if up_or_down == "up":
+        bound = row_median + (num_iqrs * row_iqr)
+    elif up_or_down == "down":
+        bound = row_median - (num_iqrs * row_iqr)
+    else:
+        raise ValueError("up_or_down must be either 'up' or 'down'")
+    if backend == "numba":
+        return _jit._outlier_mask_kernel(values, bound, up_or_down == "up")
+    with np.errstate(invalid="ignore"):
+        if up_or_down == "up":
+            return values > bound[:, np.newaxis]
+        return values < bound[:, np.newaxis]
 
 
 def _convert_to_outliers(
     df: DataFrame, samples: SampleList, num_iqrs: float, up_or_down: str
-) -> DataFrame:
+) -> Tuple[np.ndarray, np.ndarray]:
     """Calls outliers on a given values table.
 
     Args:
@@ -24,69 +185,178 @@ def _convert_to_outliers(
         up_or_down: Whether to call outliers above the median (up) or below the median (down)
 
     Returns:
-        A DataFrame with outlier calls for each value. 0 means not an outlier; 1 means there is \
-        an outlier. Missing values are propagated.
+        A boolean array that is True where a value is an outlier, and a boolean array that is \
+        True where a value is not missing. Both have the shape of df[samples].
 
     """
     if num_iqrs <= 0:
         raise ValueError("num_iqrs must be greater than 0")
+    if up_or_down not in ("up", "down"):
+        raise ValueError("up_or_down must be either 'up' or 'down'")
 
-    df = df.copy()
-    df[row_iqr_name] = scipy.stats.iqr(df[samples], axis=1, nan_policy="omit")
-    df[row_median_name] = np.nanquantile(df[samples], q=0.5, axis=1)
+    values = df[samples].to_numpy(dtype=np.float64)
+    row_median, row_iqr = _calculate_row_stats(values)
+    outlier_mask = _call_outliers(values, row_median, row_iqr, num_iqrs, up_or_down)
+    return outlier_mask, ~np.isnan(values)
 
-    outlier_df = pd.DataFrame()
 
-    if up_or_down == "up":
-        df[row_upper_bound_name] = df[row_median_name] + (num_iqrs * df[row_iqr_name])
-        outlier_df[samples] = (
-            df[samples].gt(df[row_upper_bound_name], axis=0).astype(int)
-        )
-        outlier_df[df[samples].isnull()] = np.nan
-        return outlier_df
-    elif up_or_down == "down":
-        df[row_lower_bound_name] = df[row_median_name] - (num_iqrs * df[row_iqr_name])
-        outlier_df[samples] = (
-            df[samples].lt(df[row_lower_bound_name], axis=0).astype(int)
-        )
-        outlier_df[df[samples].isnull()] = np.nan
-        return outlier_df
-    raise ValueError("up_or_down must be either 'up' or 'down'")
+def _group_index(index: pd.Index, ind_sep: str) -> Tuple[np.ndarray, pd.Index]:
+    """Factorizes row labels by the part before ind_sep, e.g. RAG2 for RAG2-S365.
+
+    Args:
+        index: Row identifiers of the values table.
+        ind_sep: The separator used in the index to separate a more general ID and less specific \
+        ID.
+
+    Returns:
+        An integer code for each row, and the sorted unique identifiers the codes point to.
+
+    """
+    prefixes = pd.Index(index).str.split(ind_sep, n=1).str[0]
+    codes, groups = pd.factorize(prefixes, sort=True)
+    return codes, pd.Index(groups)
+
+
+def _get_count_dtype(group_codes: np.ndarray, aggregate: bool, compact: bool) -> np.dtype:
+    """Picks the integer type for count matrices. Compact counts use the smallest unsigned type
+    that holds the largest possible count, i.e. the number of sites in the biggest group.
+
+    Args:
+        group_codes: Group of each row, from _group_index.
+        aggregate: Whether counts are summed over the rows of each group.
+        compact: Whether to use the smallest type rather than count_dtype.
+
+    Returns:
+        dtype for the count matrices
+
+    """
+    if not compact:
+        return np.dtype(count_dtype)
+    max_count = 1
+    if aggregate and len(group_codes):
+        max_count = int(np.bincount(group_codes).max())
+    return np.min_scalar_type(max_count)
+
+
+def _aggregate_masks(
+    masks: List[np.ndarray],
+    group_codes: np.ndarray,
+    n_groups: int,
+    dtype=count_dtype,
+    backend: str = "numpy",
+) -> List[np.ndarray]:
+    """Sums boolean masks over the rows of each group in one pass.
+
+    Args:
+        masks: Boolean arrays with the same number of rows as group_codes.
+        group_codes: Group of each row, from _group_index.
+        n_groups: Number of groups.
+        dtype: Integer type of the counts.
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns:
+        A count matrix for each mask, with a row for each group.
+
+    """
+    widths = [mask.shape[1] for mask in masks]
+    if n_groups == 0:
+        return [np.zeros((0, width), dtype=dtype) for width in widths]
+    if backend == "numba":
+        return [
+            _jit._aggregate_kernel(mask, group_codes, np.zeros((n_groups, width), dtype=dtype))
+            for mask, width in zip(masks, widths)
+        ]
+    stacked = np.concatenate(masks, axis=1)
+    if (np.diff(group_codes) < 0).any():
+        order = np.argsort(group_codes, kind="stable")
+        group_codes, stacked = group_codes[order], stacked[order]
+    starts = np.searchsorted(group_codes, np.arange(n_groups))
+    counts = np.add.reduceat(stacked, starts, axis=0, dtype=dtype)
+    return np.split(counts, np.cumsum(widths)[:-1], axis=1)
 
 
 def _convert_to_counts(
-    df: DataFrame, samples: SampleList, aggregate: bool, ind_sep: str
-) -> DataFrame:
-    """Counts outliers and non-outlier values for each sample and each row (if aggregate=False)
+    outlier_mask: np.ndarray,
+    valid_mask: np.ndarray,
+    index: pd.Index,
+    aggregate: bool,
+    group_codes: np.ndarray,
+    groups: pd.Index,
+    dtype=count_dtype,
+    backend: str = "numpy",
+) -> Tuple[np.ndarray, np.ndarray, pd.Index]:
+    """Counts outliers and non-missing values for each sample and each row (if aggregate=False)
     or each unique identifier (if aggregate=True).
 
     Args:
-        df: Outlier DataFrame from convertToOutliers function.
-        samples: List of samples to consider. Should be same list as input to convertToOutliers.
+        outlier_mask: Boolean outlier calls from convertToOutliers.
+        valid_mask: Boolean array marking non-missing values, from convertToOutliers.
+        index: Row identifiers of the values table.
         aggregate: Whether or not to collapse multiple rows with identical identifiers before \
         a separater. Collapsing values is done by counting outliers and non-outliers for each \
         sample per unique identifier.
-        ind_sep: The separator used in the index to separate a more general ID and less specific \
-        ID. e.g. in RAG2-S365 the separater is "-".
+        group_codes: Integer identifier of each row, from _group_index.
+        groups: Unique identifiers the group codes point to.
+        dtype: Integer type of the counts, see _get_count_dtype.
+        backend: "numpy" or "numba", from _get_backend.
 
     Returns:
-        Outlier DataFrame that has a column with counts of non-outliers and outliers for \
-        each sample, with a row for each input site (if no aggregation) or each unique identifier \
-        (with aggregation). This table is the input for the comparison function.
+        A matrix of outlier counts and a matrix of non-missing value counts, with samples as \
+        columns and a row for each input site (if no aggregation) or each unique identifier \
+        (with aggregation), and the index for those rows. These are the inputs for the \
+        comparison function.
 
     """
-    not_outlier_cols = [x + col_seps + col_not_outlier_suffix for x in samples]
-    outlier_cols = [x + col_seps + col_outlier_suffix for x in samples]
-
     if aggregate:
-        df.index = [ind.split(ind_sep)[0] for ind in df.index]
-        df_inv = df == 0
-
-        output_df = pd.DataFrame()
-        output_df[not_outlier_cols] = df_inv.groupby(level=0)[samples].sum()
-        output_df[outlier_cols] = df.groupby(level=0)[samples].sum()
-    elif not aggregate:
-        output_df = pd.DataFrame(index=df.index)
-        output_df[outlier_cols] = df[samples]
-        output_df[not_outlier_cols] = 1 - df[samples]
-    return output_df
+        outlier_counts, valid_counts = _aggregate_masks(
+            [outlier_mask, valid_mask], group_codes, len(groups), dtype, backend
+        )
+        return outlier_counts, valid_counts, groups
+    return outlier_mask.astype(dtype), valid_mask.astype(dtype), index
+
+
+def _pack_mask(mask: np.ndarray) -> np.ndarray:
+    """Packs a boolean mask into bits, 8 samples per byte, for site-level tables where every
+    count is 0 or 1.
+
+    Args:
+        mask: Boolean array with rows as sites and columns as samples.
+
+    Returns:
+        uint8 array with a row for each site and ceil(samples / 8) columns.
+
+    """
+    return np.packbits(mask, axis=1)
+
+
+def _unpack_mask(bits: np.ndarray, n_samples: int, dtype=count_dtype) -> np.ndarray:
+    """Unpacks bits from _pack_mask into a matrix of 0/1 counts.
+
+    Args:
+        bits: Packed mask from _pack_mask.
+        n_samples: Number of samples (columns) in the original mask.
+        dtype: Integer type of the counts.
+
+    Returns:
+        Array with a row for each site and a column for each sample.
+
+    """
+    return np.unpackbits(bits, axis=1, count=n_samples).astype(dtype, copy=False)
+
+
+def _packed_row_totals(bits: np.ndarray, positions: np.ndarray, n_samples: int) -> np.ndarray:
+    """Counts the set bits of each row for some samples, by masking the packed rows with the
+    packed sample positions and counting bits with a lookup table.
+
+    Args:
+        bits: Packed mask from _pack_mask.
+        positions: Column positions of the samples to count.
+        n_samples: Number of samples (columns) in the original mask.
+
+    Returns:
+        Number of selected samples with the bit set, for each row.
+
+    """
+    sample_mask = np.zeros(n_samples, dtype=bool)
+    sample_mask[positions] = True
+    return popcount_table[bits & np.packbits(sample_mask)].sum(axis=1, dtype=np.int64)
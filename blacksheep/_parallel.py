@@ -0,0 +1,277 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from blacksheep._outlierTable import _calculate_row_stats
+from blacksheep.classes import OutlierTable
+from blacksheep.comparisons import _run_comparisons, Comparison, Permutations
+
+
+SharedArray = Tuple[str, Tuple[int, ...], str]
+blocks_per_job = 4
+# OutlierTable of a worker process of _parallel_comparisons and the shared memory it reads
+_worker_outliers: Optional[OutlierTable] = None
+_worker_shms: List[shared_memory.SharedMemory] = []
+
+
+def _get_n_jobs(n_jobs: int) -> int:
+    """Checks the number of processes to use. Negative numbers count back from the number of
+    cores, so -1 means all cores.
+
+    Args:
+        n_jobs: Requested number of processes
+
+    Returns: Number of processes to use
+
+    """
+    if n_jobs == 0:
+        raise ValueError("n_jobs must not be 0")
+    if n_jobs < 0:
+        n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def _create_shared_array(
+    shape: Tuple[int, ...], dtype: np.dtype
+) -> Tuple[shared_memory.SharedMemory, np.ndarray, SharedArray]:
+    """Makes an empty array in a shared memory block.
+
+    Args:
+        shape: Shape of the array
+        dtype: dtype of the array
+
+    Returns: The shared memory block, the array and a description of the array that worker
+    processes can use to open it.
+
+    """
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, arr, (shm.name, tuple(shape), dtype.str)
+
+
+def _open_shared_array(spec: SharedArray) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """Opens an array made by _create_shared_array from another process, without copying it.
+
+    Args:
+        spec: Description of the array from _create_shared_array
+
+    Returns: The shared memory block and the array. The array must be deleted before the block
+    is closed.
+
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _row_blocks(n_rows: int, n_jobs: int) -> List[Tuple[int, int]]:
+    """Splits rows into contiguous blocks, a few per process so work stays balanced.
+
+    Args:
+        n_rows: Number of rows
+        n_jobs: Number of processes
+
+    Returns: List of (start, stop) row positions
+
+    """
+    bounds = np.linspace(0, n_rows, min(n_jobs * blocks_per_job, n_rows) + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _row_stats_block(
+    values_spec: SharedArray, stats_spec: SharedArray, start: int, stop: int, backend: str
+):
+    """Worker that calculates the row median and IQR for a block of rows of a shared values
+    array and writes them into a shared stats array.
+
+    Args:
+        values_spec: Shared values array, rows as sites/genes and columns as samples.
+        stats_spec: Shared array with 2 rows, for the median and IQR of each values row.
+        start: First row of the block
+        stop: Row after the last row of the block
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns: None
+
+    """
+    values_shm, values = _open_shared_array(values_spec)
+    stats_shm, stats = _open_shared_array(stats_spec)
+    stats[0, start:stop], stats[1, start:stop] = _calculate_row_stats(
+        values[start:stop], backend
+    )
+    del values, stats
+    values_shm.close()
+    stats_shm.close()
+
+
+def _parallel_row_stats(
+    values: np.ndarray, n_jobs: int, backend: str = "numpy"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculates the median and IQR of each row, splitting rows across a pool of processes.
+    Workers read the values from shared memory rather than receiving pickled copies.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+        n_jobs: Number of processes
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns:
+        Arrays with the median and IQR of each row, identical to _calculate_row_stats.
+
+    """
+    values_shm, shared_values, values_spec = _create_shared_array(values.shape, values.dtype)
+    # Stats are kept in float64, as from _calculate_row_stats, whatever the values dtype
+    stats_shm, stats, stats_spec = _create_shared_array((2, len(values)), np.float64)
+    try:
+        shared_values[...] = values
+        blocks = _row_blocks(len(values), n_jobs)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(
+                executor.map(
+                    _row_stats_block,
+                    [values_spec] * len(blocks),
+                    [stats_spec] * len(blocks),
+                    [start for start, _ in blocks],
+                    [stop for _, stop in blocks],
+                    [backend] * len(blocks),
+                )
+            )
+        row_median, row_iqr = stats[0].copy(), stats[1].copy()
+    finally:
+        del shared_values, stats
+        values_shm.close()
+        values_shm.unlink()
+        stats_shm.close()
+        stats_shm.unlink()
+    return row_median, row_iqr
+
+
+def _init_comparisons_worker(
+    count_specs: Tuple[SharedArray, SharedArray],
+    packed: bool,
+    samples: list,
+    index: pd.Index,
+    aggregated: bool,
+    bits_dtype: str,
+):
+    """Initializer of the worker processes of _parallel_comparisons. Builds the worker's
+    OutlierTable once, from count matrices (or packed bits) in shared memory, so the table's
+    labels are sent to each process once rather than with every block of comparisons.
+
+    Args:
+        count_specs: Shared outlier and non-missing value matrices, or their packed bits.
+        packed: Whether the shared arrays are packed bits.
+        samples: Samples of the OutlierTable.
+        index: Row labels of the OutlierTable.
+        aggregated: Whether the rows are sums over sites.
+        bits_dtype: Integer type of the count matrices of the OutlierTable.
+
+    Returns: None
+
+    """
+    global _worker_outliers
+    (outlier_shm, outlier_array), (valid_shm, valid_array) = [
+        _open_shared_array(spec) for spec in count_specs
+    ]
+    # The blocks stay open for as long as the process uses the arrays
+    _worker_shms[:] = [outlier_shm, valid_shm]
+    arrays = {"outlier_bits": outlier_array, "valid_bits": valid_array} if packed else {
+        "outlier_counts": outlier_array, "valid_counts": valid_array
+    }
+    _worker_outliers = OutlierTable(
+        None, None, None, samples, None, index=index, aggregated=aggregated,
+        bits_dtype=bits_dtype, **arrays
+    )
+
+
+def _comparisons_block(
+    comparisons: List[Comparison],
+    frac_filter: Optional[float],
+    backend: str,
+    permutations: Permutations = None,
+) -> list:
+    """Worker that runs a block of comparisons on the OutlierTable from
+    _init_comparisons_worker.
+
+    Args:
+        comparisons: Comparisons to run, see _run_comparisons.
+        frac_filter: Fraction of samples in group of interest require to have an outlier.
+        backend: "numpy" or "numba", from _get_backend.
+        permutations: Number of permutations and seed entropy, see _run_comparisons.
+
+    Returns: Output of _run_comparisons
+
+    """
+    return _run_comparisons(_worker_outliers, comparisons, frac_filter, backend, permutations)
+
+
+def _parallel_comparisons(
+    outliers: OutlierTable,
+    comparisons: List[Comparison],
+    frac_filter: Optional[float],
+    n_jobs: int,
+    backend: str = "numpy",
+    permutations: Permutations = None,
+) -> list:
+    """Runs comparisons across a pool of processes. The count matrices are copied into shared
+    memory once, the rest of the table is sent to each process once when it starts, and each
+    process runs contiguous blocks of comparisons, so results come back in the same order as
+    _run_comparisons.
+
+    Args:
+        outliers: OutlierTable to compare groups in.
+        comparisons: Comparisons to run, see _run_comparisons.
+        frac_filter: Fraction of samples in group of interest require to have an outlier.
+        n_jobs: Number of processes
+        backend: "numpy" or "numba", from _get_backend.
+        permutations: Number of permutations and seed entropy, see _run_comparisons. \
+        Permutations are seeded for each comparison, so p-values are the same as with one \
+        process.
+
+    Returns: Output of _run_comparisons
+
+    """
+    if outliers.packed:
+        counts = (outliers.outlier_bits, outliers.valid_bits)
+    else:
+        counts = (outliers.outlier_counts, outliers.valid_counts)
+    shms, count_specs = [], []
+    try:
+        for array in counts:
+            shm, shared_array, spec = _create_shared_array(array.shape, array.dtype)
+            shms.append(shm)
+            count_specs.append(spec)
+            shared_array[...] = array
+            del shared_array
+        count_specs = tuple(count_specs)
+        blocks = _row_blocks(len(comparisons), n_jobs)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_comparisons_worker,
+            initargs=(
+                count_specs,
+                outliers.packed,
+                list(outliers.samples),
+                outliers.index,
+                outliers.aggregated,
+                outliers.bits_dtype,
+            ),
+        ) as executor:
+            block_results = list(
+                executor.map(
+                    _comparisons_block,
+                    [comparisons[start:stop] for start, stop in blocks],
+                    [frac_filter] * len(blocks),
+                    [backend] * len(blocks),
+                    [permutations] * len(blocks),
+                )
+            )
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return [result for results in block_results for result in results]
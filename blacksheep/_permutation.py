@@ -0,0 +1,118 @@
+from typing import Tuple
+import numpy as np
+
+
+batch_size = 256
+# Rows stop being permuted once this many permutations are at least as extreme as the
+# observed labels, as in Besag and Clifford's sequential p-values
+stop_exceedances = 10
+# Rate differences within this of the observed one count as ties
+tie_tolerance = 1e-10
+
+
+def _rate_difference(
+    outliers0: np.ndarray, valid0: np.ndarray, outliers1: np.ndarray, valid1: np.ndarray
+) -> np.ndarray:
+    """Outlier rate in group0 minus the rate in group1. Groups with no values have a rate of 0.
+    """
+    rates = []
+    for outliers, valid in ((outliers0, valid0), (outliers1, valid1)):
+        rates.append(
+            np.divide(outliers, valid, out=np.zeros(np.shape(outliers)), where=valid > 0)
+        )
+    return rates[0] - rates[1]
+
+
+def _permutation_indicator(
+    n_samples: int, n_group0: int, n_batch: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Draws random group0 labels for a batch of permutations.
+
+    Args:
+        n_samples: Number of samples in both groups.
+        n_group0: Number of samples in group0.
+        n_batch: Number of permutations.
+        rng: Random number generator.
+
+    Returns: Array with a row for each sample and a column for each permutation, 1 where the
+    sample is in group0.
+
+    """
+    keys = rng.random((n_batch, n_samples))
+    chosen = np.argpartition(keys, n_group0 - 1, axis=1)[:, :n_group0]
+    indicator = np.zeros((n_samples, n_batch))
+    indicator[chosen, np.arange(n_batch)[:, np.newaxis]] = 1
+    return indicator
+
+
+def _permutation_pvalues(
+    outlier_counts: np.ndarray,
+    valid_counts: np.ndarray,
+    in_group0: np.ndarray,
+    n_permutations: int,
+    rng: np.random.Generator,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """One-sided permutation p-values for a higher outlier rate in group0 than in group1, for
+    every row at once. Sample labels are permuted in batches, and the group totals of every
+    row are summed with one product of the counts with an indicator matrix per batch. Samples
+    keep all of their sites, so sites of the same sample are permuted together. Each row stops
+    once stop_exceedances permutations are at least as extreme as the observed labels.
+
+    Args:
+        outlier_counts: Outliers of each row (rows) in each sample of both groups (columns).
+        valid_counts: Non-missing values of each row in each sample.
+        in_group0: Boolean array of which columns are in group0.
+        n_permutations: Maximum number of permutations for each row.
+        rng: Random number generator. Permutations do not depend on which rows have stopped, \
+        so the p-value of a row does not depend on the other rows.
+
+    Returns: Array of p-values, and the number of permutations used for each row.
+
+    """
+    outlier_counts = np.asarray(outlier_counts, dtype=np.float64)
+    valid_counts = np.asarray(valid_counts, dtype=np.float64)
+    n_rows, n_samples = outlier_counts.shape
+    n_group0 = int(np.sum(in_group0))
+    total_outliers = outlier_counts.sum(axis=1)
+    total_valid = valid_counts.sum(axis=1)
+    outliers0 = outlier_counts[:, in_group0].sum(axis=1)
+    valid0 = valid_counts[:, in_group0].sum(axis=1)
+    threshold = (
+        _rate_difference(outliers0, valid0, total_outliers - outliers0, total_valid - valid0)
+        - tie_tolerance
+    )
+
+    exceedances = np.zeros(n_rows, dtype=np.int64)
+    used = np.zeros(n_rows, dtype=np.int64)
+    stopped = np.zeros(n_rows, dtype=bool)
+    active = np.arange(n_rows)
+    done = 0
+    while done < n_permutations and len(active) > 0:
+        n_batch = min(batch_size, n_permutations - done)
+        indicator = _permutation_indicator(n_samples, n_group0, n_batch, rng)
+        outliers0 = outlier_counts[active] @ indicator
+        valid0 = valid_counts[active] @ indicator
+        statistic = _rate_difference(
+            outliers0,
+            valid0,
+            total_outliers[active, np.newaxis] - outliers0,
+            total_valid[active, np.newaxis] - valid0,
+        )
+        seen = exceedances[active, np.newaxis] + np.cumsum(
+            statistic >= threshold[active, np.newaxis], axis=1
+        )
+        stopping = seen[:, -1] >= stop_exceedances
+        # Rows that stop in this batch only count permutations up to their last exceedance
+        used[active] += np.where(
+            stopping, np.argmax(seen >= stop_exceedances, axis=1) + 1, n_batch
+        )
+        exceedances[active] = np.minimum(seen[:, -1], stop_exceedances)
+        stopped[active[stopping]] = True
+        active = active[~stopping]
+        done += n_batch
+    pvalues = np.where(
+        stopped,
+        exceedances / np.maximum(used, 1),
+        (exceedances + 1) / (used + 1),
+    )
+    return pvalues, used
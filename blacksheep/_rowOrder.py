@@ -0,0 +1,138 @@
+from typing import Optional, Tuple
+import numpy as np
+from blacksheep._outlierTable import _lerp, RowQuantiles
+
+
+def _sort_rows(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Orders the values of each row, with missing values last.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+
+    Returns:
+        The ordered rows, and the number of non-missing values in each row.
+
+    """
+    return np.sort(values, axis=1), (~np.isnan(values)).sum(axis=1)
+
+
+def _search_rows(ordered: np.ndarray, n_valid: np.ndarray, value: np.ndarray) -> np.ndarray:
+    """Binary search for one value per row, over all rows at once, so each row takes
+    log2(samples) steps.
+
+    Args:
+        ordered: Ordered rows from _sort_rows.
+        n_valid: Number of non-missing values in each row.
+        value: Value to look for in each row.
+
+    Returns:
+        Position of the first non-missing value in each row that is not less than value.
+        Missing values are placed after the non-missing values.
+
+    """
+    rows = np.arange(len(ordered))
+    low = np.zeros(len(ordered), dtype=np.intp)
+    high = n_valid.astype(np.intp)
+    last = max(ordered.shape[1] - 1, 0)
+    while (low < high).any():
+        middle = (low + high) // 2
+        searching = low < high
+        less = ordered[rows, np.minimum(middle, last)] < value
+        low = np.where(searching & less, middle + 1, low)
+        high = np.where(searching & ~less, middle, high)
+    return np.where(np.isnan(value), n_valid, low)
+
+
+def _edited_row_quantiles(
+    ordered: np.ndarray,
+    n_valid: np.ndarray,
+    removed: Optional[np.ndarray] = None,
+    inserted: Optional[np.ndarray] = None,
+    inserted_at: Optional[np.ndarray] = None,
+) -> RowQuantiles:
+    """Calculates the quartiles of each row after removing or inserting one value, without
+    reordering. Order statistics of the edited row are read from the ordered row with their
+    positions shifted around the edit, so results are identical to _row_quantiles of the edited
+    values.
+
+    Args:
+        ordered: Ordered rows from _sort_rows.
+        n_valid: Number of non-missing values in each row.
+        removed: Position in each ordered row of the value to remove, from _search_rows.
+        inserted: Value to insert in each row. Missing values do not change the quartiles.
+        inserted_at: Position of the inserted value in each ordered row, from _search_rows.
+
+    Returns:
+        Arrays with the first quartile, median and third quartile of each edited row.
+
+    """
+    rows = np.arange(len(ordered))
+    last_column = max(ordered.shape[1] - 1, 0)
+    if removed is not None:
+        edited = removed < n_valid
+        n_edited = n_valid - edited
+    elif inserted is not None:
+        edited = ~np.isnan(inserted)
+        n_edited = n_valid + edited
+    else:
+        n_edited = n_valid
+
+    def order_statistic(position):
+        if removed is not None:
+            position = position + (edited & (position >= removed))
+        elif inserted is not None:
+            shifted = np.maximum(position - (edited & (position > inserted_at)), 0)
+            statistic = ordered[rows, np.minimum(shifted, last_column)]
+            return np.where(edited & (position == inserted_at), inserted, statistic)
+        return ordered[rows, np.minimum(position, last_column)]
+
+    last = np.maximum(n_edited - 1, 0)
+    quantiles = []
+    for q in (0.25, 0.5, 0.75):
+        virtual = last * q
+        previous = np.floor(virtual).astype(np.intp)
+        following = np.minimum(previous + 1, last)
+        gamma = virtual - previous
+        quantile = _lerp(order_statistic(previous), order_statistic(following), gamma)
+        quantile[n_edited == 0] = np.nan
+        quantiles.append(quantile)
+    return quantiles[0], quantiles[1], quantiles[2]
+
+
+def _insert_sorted(ordered: np.ndarray, value: np.ndarray, position: np.ndarray) -> np.ndarray:
+    """Inserts one value into each ordered row.
+
+    Args:
+        ordered: Ordered rows from _sort_rows.
+        value: Value to insert in each row.
+        position: Where to insert it in each row, from _search_rows.
+
+    Returns:
+        Ordered rows with an extra column.
+
+    """
+    if ordered.shape[1] == 0:
+        return value[:, np.newaxis].astype(ordered.dtype)
+    columns = np.arange(ordered.shape[1] + 1)
+    source = np.minimum(columns - (columns > position[:, np.newaxis]), ordered.shape[1] - 1)
+    edited = np.take_along_axis(ordered, source, axis=1)
+    edited[np.arange(len(ordered)), position] = value
+    return edited
+
+
+def _delete_sorted(ordered: np.ndarray, position: np.ndarray) -> np.ndarray:
+    """Removes one value from each ordered row.
+
+    Args:
+        ordered: Ordered rows from _sort_rows.
+        position: Position of the value to remove in each row, from _search_rows. Missing \
+        values are removed from the end of the row.
+
+    Returns:
+        Ordered rows with one column less.
+
+    """
+    position = np.minimum(position, ordered.shape[1] - 1)
+    columns = np.arange(ordered.shape[1] - 1)
+    source = columns + (columns >= position[:, np.newaxis])
+    return np.take_along_axis(ordered, source, axis=1)
@@ -0,0 +1,291 @@
+from typing import Iterator, List, Tuple
+import numpy as np
+
+
+Interval = Tuple[np.ndarray, np.ndarray]
+block_columns = 1024
+block_cells = 1 << 18
+
+
+def _column_blocks(values: np.ndarray) -> Iterator[np.ndarray]:
+    """Yields blocks of columns of a values array, so sketches are built a block of samples at
+    a time.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+
+    Returns: Iterator of column blocks
+
+    """
+    for start in range(0, values.shape[1], block_columns):
+        yield values[:, start:start + block_columns]
+
+
+class _RowSketch:
+    """Mergeable quantile sketch of every row of a values table, with a bounded rank error.
+    Non-missing values are kept in levels of sorted buffers of sketch_size values per row, where
+    a value in level h stands for 2**h values. When two buffers of a row meet in a level they
+    are merged and compacted to every other value, which moves the rank of any value by at most
+    2**h, so the rank error of each row is known exactly. Missing values are dropped, so rows
+    fill their buffers at their own pace and a level can be taken in some rows and free (all
+    NaN) in others.
+
+    With n non-missing values in a row, the row keeps about sketch_size * log2(n / sketch_size)
+    values and its ranks are off by at most about n * log2(n / sketch_size) / (2 * sketch_size).
+    """
+
+    def __init__(self, n_rows: int, sketch_size: int, dtype: np.dtype = np.float64):
+        """Makes an empty sketch.
+
+        Args:
+            n_rows: Number of rows.
+            sketch_size: Number of values per row in each buffer.
+            dtype: Float type of the values.
+        """
+        self.n_rows = n_rows
+        self.sketch_size = sketch_size
+        self.dtype = np.dtype(dtype)
+        self.levels: List[np.ndarray] = []
+        self.offsets: List[int] = []
+        # Values not yet in a buffer, sorted with missing values last
+        self.pending = np.empty((n_rows, 0), dtype=self.dtype)
+        self.error = np.zeros(n_rows, dtype=np.int64)
+        self.row_min = np.full(n_rows, np.nan)
+        self.row_max = np.full(n_rows, np.nan)
+        self.valid_counts = np.zeros(n_rows, dtype=np.int64)
+
+    def update(self, block: np.ndarray):
+        """Adds a block of columns of values.
+
+        Args:
+            block: 2D array with a row for each row of the sketch.
+
+        Returns: None
+
+        """
+        self.row_min = np.fmin(self.row_min, np.fmin.reduce(block, axis=1, initial=np.nan))
+        self.row_max = np.fmax(self.row_max, np.fmax.reduce(block, axis=1, initial=np.nan))
+        self.valid_counts += block.shape[1] - np.isnan(block).sum(axis=1)
+        self._add_pending(block)
+
+    def merge(self, other: "_RowSketch"):
+        """Adds the values of another sketch of the same rows, e.g. of other samples.
+
+        Args:
+            other: Sketch with the same rows and sketch_size.
+
+        Returns: None
+
+        """
+        if (other.n_rows, other.sketch_size) != (self.n_rows, self.sketch_size):
+            raise ValueError("Only sketches of the same rows and sketch_size can be merged")
+        self.row_min = np.fmin(self.row_min, other.row_min)
+        self.row_max = np.fmax(self.row_max, other.row_max)
+        self.valid_counts += other.valid_counts
+        self.error += other.error
+        for level, buffers in enumerate(other.levels):
+            rows = np.flatnonzero(~np.isnan(buffers[:, 0]))
+            self._carry(buffers[rows], rows, level)
+        self._add_pending(other.pending)
+
+    def _add_pending(self, block: np.ndarray):
+        pending = np.concatenate([self.pending, block.astype(self.dtype, copy=False)], axis=1)
+        pending.sort(axis=1)
+        fill = pending.shape[1] - np.isnan(pending).sum(axis=1)
+        while True:
+            rows = np.flatnonzero(fill >= self.sketch_size)
+            if len(rows) == 0:
+                break
+            # The smallest values of a row make its next buffer and the rest stay pending
+            self._carry(pending[rows, :self.sketch_size], rows, 0)
+            pending[rows, :-self.sketch_size] = pending[rows, self.sketch_size:]
+            pending[rows, -self.sketch_size:] = np.nan
+            fill[rows] -= self.sketch_size
+        self.pending = pending[:, :fill.max(initial=0)].copy()
+
+    def _carry(self, buffers: np.ndarray, rows: np.ndarray, level: int):
+        """Puts a sorted buffer of each of some rows into a level, merging and compacting into
+        the next level in rows where the level is taken, like adding one to a binary counter."""
+        while len(rows) > 0:
+            if level == len(self.levels):
+                self.levels.append(
+                    np.full((self.n_rows, self.sketch_size), np.nan, dtype=self.dtype)
+                )
+                self.offsets.append(0)
+            taken = ~np.isnan(self.levels[level][rows, 0])
+            self.levels[level][rows[~taken]] = buffers[~taken]
+            rows, buffers = rows[taken], buffers[taken]
+            # Stable sorts merge the two sorted runs rather than sorting from scratch
+            merged = np.concatenate([self.levels[level][rows], buffers], axis=1)
+            merged.sort(axis=1, kind="stable")
+            # Alternating which half is kept keeps the errors of compactions from adding up
+            # in one direction
+            buffers = merged[:, self.offsets[level]::2].copy()
+            del merged
+            self.offsets[level] ^= 1
+            self.error[rows] += 2 ** level
+            self.levels[level][rows] = np.nan
+            level += 1
+
+    def _weighted_values(self, rows: slice) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Sorted values of some rows, and the total weight of the values before each value and
+        up to and including it."""
+        weights = np.concatenate(
+            [np.ones(self.pending.shape[1], dtype=np.int64)]
+            + [
+                np.full(self.sketch_size, 2 ** level, dtype=np.int64)
+                for level in range(len(self.levels))
+            ]
+        )
+        # Free levels of a row are missing values, which sort after every value of the row
+        values = np.concatenate(
+            [self.pending[rows]] + [buffers[rows] for buffers in self.levels], axis=1
+        )
+        order = np.argsort(values, axis=1, kind="stable")
+        ordered_weights = weights[order]
+        cumulative = np.cumsum(ordered_weights, axis=1)
+        ordered = np.take_along_axis(values, order, axis=1)
+        return ordered, cumulative - ordered_weights, cumulative
+
+    def _order_statistic(
+        self,
+        rows: slice,
+        ordered: np.ndarray,
+        before: np.ndarray,
+        cumulative: np.ndarray,
+        rank: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Estimates an order statistic of some rows, with bounds that contain the exact one.
+
+        Args:
+            rows: Rows of the sketch.
+            ordered: Sorted values of the rows from _weighted_values.
+            before: Weight before each value, from _weighted_values.
+            cumulative: Weight up to each value, from _weighted_values.
+            rank: 0-based rank of the order statistic in each row.
+
+        Returns: The estimate, and lower and upper bounds of the order statistic.
+
+        """
+        row_min, row_max = self.row_min[rows], self.row_max[rows]
+        positions = np.arange(len(ordered))
+        last = max(ordered.shape[1] - 1, 0)
+        rank = rank[:, np.newaxis]
+        error = self.error[rows, np.newaxis]
+
+        def value_at(position, missing):
+            value = ordered[positions, np.clip(position, 0, last)].astype(np.float64)
+            outside = (position < 0) | (position > last) | np.isnan(value)
+            return np.where(outside, missing, value)
+
+        estimate = value_at((cumulative <= rank).sum(axis=1), row_max)
+        # Values with at most rank - error weight before them are surely not above the order
+        # statistic, and values with at least rank + 1 + error weight up to them are surely
+        # not below it
+        lower = value_at((before <= rank - error).sum(axis=1) - 1, row_min)
+        upper = value_at((cumulative < rank + 1 + error).sum(axis=1), row_max)
+        return (
+            np.clip(estimate, row_min, row_max),
+            np.fmax(lower, row_min),
+            np.fmin(upper, row_max),
+        )
+
+    def row_stats(self) -> Tuple[np.ndarray, np.ndarray, Interval, Interval]:
+        """Estimates the median and IQR of each row. Rows are read a block at a time, so
+        memory stays around the size of the sketch.
+
+        Returns: Estimated median and IQR of each row, and intervals (low, high) that contain \
+        the exact median and exact IQR of each row.
+
+        """
+        n_values = self.pending.shape[1] + self.sketch_size * len(self.levels)
+        block_rows = max(block_cells // max(n_values, 1), 1)
+        # First quartile, median and third quartile, each with its lower and upper bound
+        quantiles = np.empty((3, 3, self.n_rows))
+        last = np.maximum(self.valid_counts - 1, 0)
+        for start in range(0, self.n_rows, block_rows):
+            rows = slice(start, start + block_rows)
+            ordered, before, cumulative = self._weighted_values(rows)
+            for position, q in enumerate((0.25, 0.5, 0.75)):
+                virtual = last[rows] * q
+                previous = np.floor(virtual).astype(np.int64)
+                following = np.minimum(previous + 1, last[rows])
+                gamma = virtual - previous
+                previous_stat, following_stat = [
+                    self._order_statistic(rows, ordered, before, cumulative, rank)
+                    for rank in (previous, following)
+                ]
+                # Interpolate the estimates and both bounds, as the exact quantile interpolates
+                # the exact order statistics.
+                for bound, (low, high) in enumerate(zip(previous_stat, following_stat)):
+                    quantiles[position, bound, rows] = low + gamma * (high - low)
+        (q1, q1_low, q1_high), (median, median_low, median_high), (q3, q3_low, q3_high) = (
+            quantiles
+        )
+        return (
+            median,
+            q3 - q1,
+            (median_low, median_high),
+            (np.maximum(q3_low - q1_high, 0), q3_high - q1_low),
+        )
+
+
+def _sketch_row_stats(
+    values: np.ndarray, sketch_size: int
+) -> Tuple[np.ndarray, np.ndarray, Interval, Interval]:
+    """Estimates the median and IQR of each row from a _RowSketch, built in one pass over
+    column blocks. Errors are bounded in rank rather than value, so they do not depend on the
+    spread of a row.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+        sketch_size: Number of values per row in each buffer of the sketch.
+
+    Returns: Estimated median and IQR of each row, and intervals (low, high) that contain the
+    exact median and exact IQR of each row.
+
+    """
+    sketch = _RowSketch(len(values), sketch_size, values.dtype)
+    for block in _column_blocks(values):
+        sketch.update(block)
+    return sketch.row_stats()
+
+
+def _uncertain_calls(
+    values: np.ndarray,
+    median_interval: Interval,
+    iqr_interval: Interval,
+    num_iqrs: float,
+    up_or_down: str,
+) -> np.ndarray:
+    """Counts values in each row whose outlier call could be different with the exact median
+    and IQR, i.e. values between the lowest and highest outlier bound the intervals allow.
+
+    Args:
+        values: 2D array with rows as sites/genes and columns as samples.
+        median_interval: Interval containing the exact median of each row.
+        iqr_interval: Interval containing the exact IQR of each row.
+        num_iqrs: How many IQRs above or below the median to consider something an outlier.
+        up_or_down: Whether outliers are above the median (up) or below the median (down)
+
+    Returns: Number of calls that could change in each row
+
+    """
+    (median_low, median_high), (iqr_low, iqr_high) = median_interval, iqr_interval
+    if up_or_down == "up":
+        bound_low = median_low + (num_iqrs * iqr_low)
+        bound_high = median_high + (num_iqrs * iqr_high)
+    else:
+        bound_low = median_low - (num_iqrs * iqr_high)
+        bound_high = median_high - (num_iqrs * iqr_low)
+    uncertain = np.empty(len(values), dtype=np.int64)
+    # Rows are compared a block at a time, so the masks stay small
+    block_rows = max(block_cells // max(values.shape[1], 1), 1)
+    for start in range(0, len(values), block_rows):
+        rows = slice(start, start + block_rows)
+        with np.errstate(invalid="ignore"):
+            uncertain[rows] = (
+                (values[rows] >= bound_low[rows, np.newaxis])
+                & (values[rows] <= bound_high[rows, np.newaxis])
+            ).sum(axis=1)
+    return uncertain
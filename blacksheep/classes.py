@@ -1,10 +1,14 @@
-from typing import List, Optional, Iterable
+from typing import List, Optional, Iterable, Tuple
 import logging
 import pandas as pd
 from pandas import DataFrame
 import numpy as np
 from blacksheep._constants import col_seps, col_outlier_suffix, col_not_outlier_suffix, \
-    gene_list_file_name
+    gene_list_file_name, count_dtype
+from blacksheep._outlierTable import _group_index, _unpack_mask, _packed_row_totals
+from blacksheep._outlierTable import _call_outliers, _convert_to_counts, _make_row_stats
+from blacksheep._rowOrder import _sort_rows, _search_rows, _edited_row_quantiles
+from blacksheep._rowOrder import _insert_sorted, _delete_sorted
 
 
 def list_to_file(lis: Iterable, filename: str):
@@ -32,47 +36,476 @@ def make_frac_table(df, samples):
     per sample. This table is useful for visualization but not statistics.
 
     """
-    df = df.copy()
+    outlier_counts, valid_counts = _counts_from_df(df, samples)
+    return _make_frac_table(outlier_counts, valid_counts, df.index, samples)
+
+
+def _make_frac_table(
+        outlier_counts: np.ndarray, valid_counts: np.ndarray, index: pd.Index, samples
+) -> DataFrame:
+    """Constructs the fraction table from outlier and non-missing value count matrices.
+    Compact (8 or 16 bit) counts give float32 fractions, other counts give float64.
+
+    Returns: A DataFrame with one column per sample, with the fraction of outliers per row
+    per sample.
+
+    """
+    frac_dtype = np.result_type(outlier_counts.dtype, np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac_table = np.divide(outlier_counts, valid_counts, dtype=frac_dtype)
+    return DataFrame(frac_table, index=index, columns=samples)
+
+
+def _counts_from_df(df: DataFrame, samples) -> Tuple[np.ndarray, np.ndarray]:
+    """Parses a wide outlier count table into a matrix of outlier counts and a matrix of
+    non-missing value counts.
+
+    Args:
+        df: DataFrame with <sample>_outliers and <sample>_notOutliers columns.
+        samples: Samples to take columns for, in order.
+
+    Returns: outlier_counts, valid_counts
+
+    """
     cols_outliers = [x + col_seps + col_outlier_suffix for x in samples]
     cols_notOutliers = [x + col_seps + col_not_outlier_suffix for x in samples]
-    df = df.fillna(0)
-    num_total_psites = df[cols_notOutliers].values + df[cols_outliers].values
-    with np.errstate(divide="ignore", invalid="ignore"):
-        frac_table = df[cols_outliers].values / num_total_psites
+    outlier_counts = df[cols_outliers].fillna(0).to_numpy(dtype=count_dtype)
+    not_outlier_counts = df[cols_notOutliers].fillna(0).to_numpy(dtype=count_dtype)
+    return outlier_counts, outlier_counts + not_outlier_counts
+
 
-    return DataFrame(frac_table, index=df.index, columns=samples)
+def _df_from_counts(
+        outlier_counts: np.ndarray,
+        valid_counts: np.ndarray,
+        index: pd.Index,
+        samples,
+        aggregated: bool,
+) -> DataFrame:
+    """Builds the wide outlier count table, with a <sample>_outliers and a
+    <sample>_notOutliers column for each sample. Rows that were not aggregated have missing
+    values where the value was missing.
+
+    Returns: DataFrame with outlier and non-outlier columns
+
+    """
+    cols_outliers = [x + col_seps + col_outlier_suffix for x in samples]
+    cols_notOutliers = [x + col_seps + col_not_outlier_suffix for x in samples]
+    not_outlier_counts = valid_counts - outlier_counts
+    if aggregated:
+        return DataFrame(
+            np.hstack([not_outlier_counts, outlier_counts]),
+            index=index,
+            columns=cols_notOutliers + cols_outliers,
+        )
+    missing = np.where(valid_counts > 0, 0, np.nan)
+    return DataFrame(
+        np.hstack([outlier_counts + missing, not_outlier_counts + missing]),
+        index=index,
+        columns=cols_outliers + cols_notOutliers,
+    )
 
 
 class OutlierTable:
-    """Output of calling outliers. """
+    """Output of calling outliers. Outlier counts and counts of non-missing values are kept as
+    two integer matrices with genes/sites as rows and samples as columns. Site-level tables
+    made by make_outliers_table keep them as packed bits instead, since every count is 0 or 1.
+    """
 
     def __init__(
             self,
-            df: DataFrame,
+            df: Optional[DataFrame],
             updown: str,
             iqrs: Optional[float],
             samples: Optional[list],
             frac_table: Optional[DataFrame],
+            outlier_counts: Optional[np.ndarray] = None,
+            valid_counts: Optional[np.ndarray] = None,
+            index: Optional[pd.Index] = None,
+            aggregated: bool = True,
+            group_codes: Optional[np.ndarray] = None,
+            groups: Optional[pd.Index] = None,
+            row_stats: Optional[DataFrame] = None,
+            outlier_bits: Optional[np.ndarray] = None,
+            valid_bits: Optional[np.ndarray] = None,
+            bits_dtype: str = count_dtype,
     ):
         """Instantiate an OutlierTable
 
         Args:
-            df: DataFrame with outlier and non-outlier columns, and genes/sites as rows.
+            df: DataFrame with outlier and non-outlier columns, and genes/sites as rows. Can be
+            None if outlier_counts, valid_counts and index are given.
             updown: Whether the outliers are above or below the median. Options are "up" or "down"
             iqrs: The IQR threshold used to call outliers.
             samples: The samples included in the analysis to define median and IQR.
             frac_table: DataFrame with samples as columns and genes/sites as rows indicating
             what fraction of sites per sample were called as outliers. Useful for visualization.
+            outlier_counts: Matrix of outlier counts, genes/sites as rows and samples as columns.
+            valid_counts: Matrix of counts of non-missing values, same shape as outlier_counts.
+            index: Labels for the rows of the count matrices.
+            aggregated: Whether rows are sums over sites. If not, the wide df has missing values
+            where values were missing.
+            group_codes: Integer gene identifier of each row of the values table the outliers
+            were called from, e.g. the code of RAG2 for RAG2-S365.
+            groups: The unique genes that group_codes point to.
+            row_stats: DataFrame with the median, IQR and outlier bounds of each row of the
+            values table. Can be used to call outliers again without recalculating them.
+            outlier_bits: Outlier calls packed 8 samples per byte, from _pack_mask, for tables
+            that are not aggregated. Used instead of outlier_counts.
+            valid_bits: Packed non-missing value mask, used instead of valid_counts.
+            bits_dtype: Integer type of the count matrices unpacked from the bits.
         """
 
-        self.df = df
         self.up_or_down = updown
         self.iqrs = iqrs
         self.samples = samples
-        if frac_table is not None:
-            self.frac_table = frac_table
+        self.aggregated = aggregated
+        self.group_codes = group_codes
+        self.groups = groups
+        self.row_stats = row_stats
+        self.bits_dtype = bits_dtype
+        if df is not None:
+            self.df = df
+        else:
+            self.outlier_counts = outlier_counts
+            self.valid_counts = valid_counts
+            self.outlier_bits = outlier_bits
+            self.valid_bits = valid_bits
+            self.index = index
+            self._df = None
+        self._frac_table = frac_table
+
+    @property
+    def packed(self) -> bool:
+        """Whether outlier calls are kept as packed bits rather than count matrices."""
+        return self.outlier_bits is not None
+
+    @property
+    def outlier_counts(self) -> np.ndarray:
+        """Matrix of outlier counts, genes/sites as rows and samples as columns. Unpacked from
+        the bits each time it is used if the table is packed."""
+        if self._outlier_counts is None and self.packed:
+            return _unpack_mask(self.outlier_bits, len(self.samples), self.bits_dtype)
+        return self._outlier_counts
+
+    @outlier_counts.setter
+    def outlier_counts(self, outlier_counts: np.ndarray):
+        self._outlier_counts = outlier_counts
+        self._totals_operands = None
+
+    @property
+    def valid_counts(self) -> np.ndarray:
+        """Matrix of counts of non-missing values, same shape as outlier_counts."""
+        if self._valid_counts is None and self.packed:
+            return _unpack_mask(self.valid_bits, len(self.samples), self.bits_dtype)
+        return self._valid_counts
+
+    @valid_counts.setter
+    def valid_counts(self, valid_counts: np.ndarray):
+        self._valid_counts = valid_counts
+        self._totals_operands = None
+
+    @property
+    def df(self) -> DataFrame:
+        """Wide outlier count table, with a <sample>_outliers and <sample>_notOutliers column
+        per sample. Made from the count matrices the first time it is used."""
+        if self._df is None:
+            self._df = _df_from_counts(
+                self.outlier_counts, self.valid_counts, self.index, self.samples, self.aggregated
+            )
+        return self._df
+
+    @df.setter
+    def df(self, df: DataFrame):
+        if self.samples is None:
+            self.samples = sorted(list(set([ind.rsplit(col_seps, 1)[0] for ind in df.columns])))
+        self.outlier_counts, self.valid_counts = _counts_from_df(df, self.samples)
+        self.outlier_bits = self.valid_bits = None
+        self.index = df.index
+        self._df = df
+        self._frac_table = None
+
+    @property
+    def frac_table(self) -> DataFrame:
+        """DataFrame with the fraction of values that are outliers per row, per sample."""
+        if self._frac_table is None:
+            self._frac_table = _make_frac_table(
+                self.outlier_counts, self.valid_counts, self.index, self.samples
+            )
+        return self._frac_table
+
+    @frac_table.setter
+    def frac_table(self, frac_table: DataFrame):
+        self._frac_table = frac_table
+
+    def subset_by_genes(self, ind_list: Iterable[str], ind_sep: Optional[str] = None):
+        """Makes an OutlierTable with only some rows. Rows are selected using the group index
+        from calling outliers when there is one, rather than splitting row labels again.
+
+        Args:
+            ind_list: Genes/sites to keep.
+            ind_sep: If rows are sites, the separator between gene and site in row labels. Rows
+            whose gene is in ind_list are kept. If None, rows whose label is in ind_list are kept.
+
+        Returns: OutlierTable with the selected rows
+
+        """
+        group_codes, groups = self.group_codes, self.groups
+        if ind_sep:
+            if (group_codes is None) or self.aggregated:
+                group_codes, groups = _group_index(self.index, ind_sep)
+            rows = np.flatnonzero(groups.isin(list(ind_list))[group_codes])
+        else:
+            rows = self.index.get_indexer(list(ind_list))
+            if (rows < 0).any():
+                raise KeyError("%s not in outliers table" % list(np.array(ind_list)[rows < 0]))
+
+        if self.aggregated:
+            group_codes, groups = None, self.index[rows]
+        elif group_codes is not None:
+            group_codes = group_codes[rows]
+
+        if self.packed:
+            counts = dict(
+                outlier_bits=self.outlier_bits[rows],
+                valid_bits=self.valid_bits[rows],
+                bits_dtype=self.bits_dtype,
+            )
         else:
-            self.frac_table = make_frac_table(df, samples)
+            counts = dict(
+                outlier_counts=self.outlier_counts[rows], valid_counts=self.valid_counts[rows]
+            )
+        return OutlierTable(
+            None,
+            self.up_or_down,
+            self.iqrs,
+            self.samples,
+            None,
+            index=self.index[rows],
+            aggregated=self.aggregated,
+            group_codes=group_codes,
+            groups=groups,
+            row_stats=self.row_stats,
+            **counts,
+        )
+
+    def row_counts(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Count matrices for some rows. Packed tables only unpack those rows.
+
+        Args:
+            rows: Boolean array or positions of the rows.
+
+        Returns: outlier_counts, valid_counts
+
+        """
+        if self.packed:
+            return (
+                _unpack_mask(self.outlier_bits[rows], len(self.samples), self.bits_dtype),
+                _unpack_mask(self.valid_bits[rows], len(self.samples), self.bits_dtype),
+            )
+        return self.outlier_counts[rows], self.valid_counts[rows]
+
+    def indicator_totals(
+            self, indicator: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Sums counts over many groups of samples at once, as one matrix product of the count
+        matrices with a sample by group indicator matrix. Packed tables count bits for each
+        group instead.
+
+        Args:
+            indicator: Array with a row for each sample in the table and a column for each \
+            group, that is 1 where a sample is in a group and 0 elsewhere.
+
+        Returns: Arrays with a row for each row of the table and a column for each group: the
+        number of outliers, the number of non-missing values and the number of samples with at
+        least one outlier in the group.
+
+        """
+        if self.packed:
+            n_samples = len(self.samples)
+            groups = [np.flatnonzero(column) for column in indicator.T]
+            outlier_totals, valid_totals = [
+                np.column_stack(
+                    [_packed_row_totals(bits, positions, n_samples) for positions in groups]
+                ).reshape(len(bits), len(groups))
+                for bits in (self.outlier_bits, self.valid_bits)
+            ]
+            return outlier_totals, valid_totals, outlier_totals
+        operands = self._get_totals_operands()
+        indicator = np.asarray(indicator, dtype=operands[0].dtype)
+        return tuple((counts @ indicator).astype(np.int64) for counts in operands)
+
+    def _get_totals_operands(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Float matrices that indicator_totals multiplies: outlier counts, non-missing value
+        counts and whether each sample has an outlier. Float products go through BLAS, which is
+        many times faster than integer matrix products. They are made once per table, so blocks
+        of comparisons do not copy the count matrices again.
+
+        Returns: outlier counts, valid counts and outlier indicators, all float32 unless totals \
+        could be too large to be exact in it.
+
+        """
+        if self._totals_operands is None:
+            outlier_counts, valid_counts = self._outlier_counts, self._valid_counts
+            # Every partial sum of a product is at most a row's total, and whole numbers are
+            # exact in float32 below 2**24 and in float64 below 2**53
+            most = int(valid_counts.max(initial=0)) * valid_counts.shape[1]
+            dtype = np.float32 if most < 2 ** 24 else np.float64
+            self._totals_operands = (
+                outlier_counts.astype(dtype, copy=False),
+                valid_counts.astype(dtype, copy=False),
+                (outlier_counts > 0).astype(dtype),
+            )
+        return self._totals_operands
+
+
+class OrderedOutlierTable(OutlierTable):
+    """OutlierTable that keeps the values of each row in order, so a sample can be added or
+    removed without ordering every row again. The position of the sample's value in each row is
+    found with a binary search, and the new medians and IQRs are read from the ordered rows.
+    """
+
+    def __init__(
+            self,
+            df: DataFrame,
+            iqrs: float = 1.5,
+            up_or_down: str = "up",
+            aggregate: bool = True,
+            ind_sep: str = "-",
+    ):
+        """Calls outliers in a DataFrame of values and keeps the values ordered.
+
+        Args:
+            df: Input DataFrame with samples as columns and sites/genes as rows.
+            iqrs: The number of IQRs above or below the median to consider a value an outlier.
+            up_or_down: Whether to call outliers above (up) or below (down) the median.
+            aggregate: Whether to sum outliers per gene.
+            ind_sep: The separator used in sites to separate a gene and site.
+        """
+        group_codes, groups = _group_index(df.index, ind_sep)
+        super().__init__(
+            None,
+            up_or_down,
+            iqrs,
+            list(df.columns),
+            None,
+            aggregated=aggregate,
+            group_codes=group_codes,
+            groups=groups,
+        )
+        self.values = df.to_numpy(dtype=np.float64)
+        self.row_index = df.index
+        self.ordered, self.n_valid = _sort_rows(self.values)
+        q1, row_median, q3 = _edited_row_quantiles(self.ordered, self.n_valid)
+        self._set_calls(self.values, self.samples, row_median, q3 - q1)
+
+    def _count_calls(
+            self, values: np.ndarray, row_median: np.ndarray, row_iqr: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, pd.Index]:
+        """Calls outliers in values from row statistics and counts them."""
+        return _convert_to_counts(
+            _call_outliers(values, row_median, row_iqr, self.iqrs, self.up_or_down),
+            ~np.isnan(values),
+            self.row_index,
+            self.aggregated,
+            self.group_codes,
+            self.groups,
+        )
+
+    def _set_calls(
+            self, values: np.ndarray, samples: list, row_median: np.ndarray, row_iqr: np.ndarray
+    ):
+        """Calls outliers from row statistics and replaces the count matrices."""
+        self.samples = samples
+        self.row_stats = _make_row_stats(self.row_index, row_median, row_iqr, self.iqrs)
+        self.outlier_counts, self.valid_counts, self.index = self._count_calls(
+            values, row_median, row_iqr
+        )
+        self._df = None
+        self._frac_table = None
+
+    def _sample_values(self, sample: str) -> np.ndarray:
+        if sample not in self.samples:
+            raise KeyError("%s not in outliers table" % sample)
+        return self.values[:, self.samples.index(sample)]
+
+    def add_sample(self, sample: str, values: Iterable[float]):
+        """Adds a sample and calls outliers again with the new row medians and IQRs.
+
+        Args:
+            sample: Name of the new sample.
+            values: Value of the sample in each row. A Series is matched to the rows by label.
+
+        Returns: None
+
+        """
+        if sample in self.samples:
+            raise ValueError("%s is already in outliers table" % sample)
+        if isinstance(values, pd.Series):
+            values = values.reindex(self.row_index)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (len(self.row_index),):
+            raise ValueError("values must have one value per row")
+        position = _search_rows(self.ordered, self.n_valid, values)
+        q1, row_median, q3 = _edited_row_quantiles(
+            self.ordered, self.n_valid, inserted=values, inserted_at=position
+        )
+        self.ordered = _insert_sorted(self.ordered, values, position)
+        self.n_valid = self.n_valid + ~np.isnan(values)
+        self.values = np.column_stack([self.values, values])
+        self._set_calls(self.values, self.samples + [sample], row_median, q3 - q1)
+
+    def remove_sample(self, sample: str):
+        """Removes a sample and calls outliers again with the new row medians and IQRs.
+
+        Args:
+            sample: Name of the sample to remove.
+
+        Returns: None
+
+        """
+        values = self._sample_values(sample)
+        position = _search_rows(self.ordered, self.n_valid, values)
+        q1, row_median, q3 = _edited_row_quantiles(self.ordered, self.n_valid, removed=position)
+        self.ordered = _delete_sorted(self.ordered, position)
+        self.n_valid = self.n_valid - ~np.isnan(values)
+        column = self.samples.index(sample)
+        self.values = np.delete(self.values, column, axis=1)
+        self._set_calls(
+            self.values, [s for s in self.samples if s != sample], row_median, q3 - q1
+        )
+
+    def without_sample(self, sample: str) -> OutlierTable:
+        """Makes the OutlierTable that leaving out one sample would give, without changing this
+        table.
+
+        Args:
+            sample: Name of the sample to leave out.
+
+        Returns: OutlierTable without the sample
+
+        """
+        values = self._sample_values(sample)
+        position = _search_rows(self.ordered, self.n_valid, values)
+        q1, row_median, q3 = _edited_row_quantiles(self.ordered, self.n_valid, removed=position)
+        kept = np.array([s != sample for s in self.samples])
+        samples = [s for s in self.samples if s != sample]
+        outlier_counts, valid_counts, index = self._count_calls(
+            self.values[:, kept], row_median, q3 - q1
+        )
+        return OutlierTable(
+            None,
+            self.up_or_down,
+            self.iqrs,
+            samples,
+            None,
+            outlier_counts=outlier_counts,
+            valid_counts=valid_counts,
+            index=index,
+            aggregated=self.aggregated,
+            group_codes=self.group_codes,
+            groups=self.groups,
+            row_stats=_make_row_stats(self.row_index, row_median, q3 - q1, self.iqrs),
+        )
 
 
 class qValues:
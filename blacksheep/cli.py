@@ -6,9 +6,10 @@ import argparse
 import matplotlib.pyplot as plt
 from blacksheep.deva import deva
 from blacksheep.deva import make_outliers_table
+from blacksheep.deva import recall_outliers
 from blacksheep.deva import compare_groups_outliers
 from blacksheep import parsers
-from blacksheep.parsers import _is_valid_file, _check_output_prefix, subset_by_genes
+from blacksheep.parsers import _is_valid_file, _check_output_prefix
 from blacksheep.classes import qValues
 from blacksheep.simulate import run_simulations
 from blacksheep.visualization import plot_heatmap
@@ -43,6 +44,16 @@ def _check_positive(arg: str) -> float:
     return arg
 
 
+def _check_positive_int(arg: str) -> int:
+    try:
+        arg = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a valid integer" % arg)
+    if arg < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % arg)
+    return arg
+
+
 def _bn0and1(arg: str) -> float:
     try:
         arg = float(arg)
@@ -99,17 +110,20 @@ def _make_parser():
     outliers_table.add_argument(
         "--iqrs",
         type=_check_positive,
-        default=1.5,
+        default=[1.5],
+        nargs="+",
         help="Number of interquartile ranges (IQRs) above or below the "
-             "median to consider a value an outlier. Default is 1.5 IQRs.",
+             "median to consider a value an outlier. Several thresholds can be given, in which "
+             "case row medians and IQRs are calculated once and a table is written for each "
+             "threshold, with '.iqrs<threshold>' added to the output prefix. Default is 1.5 IQRs.",
     )
     outliers_table.add_argument(
         "--up_or_down",
         type=str,
-        default="true",
-        choices=["up", "down"],
-        help="Whether to look for up or down outliers. Choices are up or "
-             "down. Default up.",
+        default="up",
+        choices=["up", "down", "both"],
+        help="Whether to look for up or down outliers. Choices are up, "
+             "down or both. Default up.",
     )
     outliers_table.add_argument(
         "--ind_sep",
@@ -133,6 +147,75 @@ def _make_parser():
              "values per site, per sample that are outliers. Will not be "
              "written by default. Useful for visualization. ",
     )
+    outliers_table.add_argument(
+        "--write_row_stats",
+        default=False,
+        action="store_true",
+        help="Use flag if you want to write a table with the median, IQR and outlier bounds "
+             "of each row, which can be used to call outliers again at other thresholds "
+             "without recalculating them. Will not be written by default. ",
+    )
+    outliers_table.add_argument(
+        "--reference_row_stats",
+        type=_is_valid_file,
+        default=None,
+        help="File path to row statistics written with --write_row_stats for a reference "
+             "cohort. Outliers in the input values are called against the reference medians "
+             "and IQRs instead of the input's own, so new samples can be scored without "
+             "rerunning the whole cohort. Rows missing from the reference have no outliers. "
+             "Only .tsv and .csv accepted. ",
+    )
+    outliers_table.add_argument(
+        "--chunksize",
+        type=_check_positive_int,
+        default=None,
+        help="Number of rows of the values file to process at a time. Tables are written "
+             "as each block is finished, so memory use depends on the chunksize rather than "
+             "the file size. When aggregating, rows of each gene must be next to each other "
+             "in the file. Default reads the whole file at once. ",
+    )
+    outliers_table.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use when calculating row medians and IQRs. -1 uses all "
+             "cores. Default 1.",
+    )
+    outliers_table.add_argument(
+        "--dtype",
+        type=str,
+        default="float64",
+        choices=value_dtypes,
+        help="Float type to read values and call outliers in. float32 roughly halves memory "
+             "use and stores counts in the smallest integer type that fits. Values within "
+             "float32 rounding of an outlier bound can be called differently. Default float64.",
+    )
+    outliers_table.add_argument(
+        "--approximate",
+        default=False,
+        action="store_true",
+        help="Use flag to estimate row medians and IQRs from a quantile sketch of each row "
+             "instead of calculating them exactly. The values are still read into memory. "
+             "With the numpy backend the sketch uses less extra memory than exact statistics "
+             "but is slower; with the numba backend it uses more memory but is faster on wide "
+             "tables. The number of calls that could change with exact statistics is logged. ",
+    )
+    outliers_table.add_argument(
+        "--sketch_size",
+        type=_check_positive_int,
+        default=1024,
+        help="Number of values per row in each level of the sketch with --approximate. Ranks "
+             "of estimates are off by at most about values * log2(values / this) / (2 * this), "
+             "where values is the number of non-missing values in the row. Default 1024.",
+    )
+    outliers_table.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Use flag to only recalculate rows whose values changed since the last run with "
+             "the same output prefix. A manifest of row hashes is written next to the count "
+             "tables. ",
+    )
 
     binarize = subparsers.add_parser(
         "binarize",
@@ -174,10 +257,10 @@ def _make_parser():
         "annotations",
         type=_is_valid_file,
         help="Table of annotations. Must be .csv or .tsv. Samples as rows "
-             "and comparisons as columns. Comparisons must have only  "
-             "unique values (not including missing values). If there are "
-             "more options than that, you can use binarize to prepare the "
-             "table. ",
+             "and comparisons as columns. Comparisons must have at least 2 "
+             "unique values (not including missing values). Columns with more "
+             "compare each value to the rest of the samples, as if the table "
+             "had been prepared with binarize. ",
     )
     compare_groups.add_argument(
         "--ind_subset",
@@ -261,6 +344,34 @@ def _make_parser():
              "have a 'value    color' format for each value in annotations. Any value not "
              "represented will be assigned a new color. ",
     )
+    compare_groups.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes to run comparisons in. -1 uses all cores. Default 1.",
+    )
+    compare_groups.add_argument(
+        "--test",
+        type=str,
+        default="fisher",
+        choices=comparison_tests,
+        help="Test for enrichment of outliers. permutation permutes sample labels, keeping the "
+             "sites of each sample together, instead of treating sites as independent in a "
+             "fisher exact test. Default fisher.",
+    )
+    compare_groups.add_argument(
+        "--n_permutations",
+        type=int,
+        default=1000,
+        help="Maximum number of permutations for each row if --test permutation is used. Rows "
+             "stop early once they are clearly not significant. Default 1000.",
+    )
+    compare_groups.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the permutations if --test permutation is used. Default random.",
+    )
 
     visualize = subparsers.add_parser(
         "visualize",
@@ -358,16 +469,20 @@ def _make_parser():
     deva.add_argument(
         "--iqrs",
         type=_check_positive,
-        default=1.5,
+        default=[1.5],
+        nargs="+",
         help="Number of inter-quartile ranges (IQRs) above or below the "
-             "median to consider a value an outlier. Default is 1.5.",
+             "median to consider a value an outlier. Several thresholds can be given, in which "
+             "case outputs for each threshold have '.iqrs<threshold>' added to the output "
+             "prefix. Default is 1.5.",
     )
     deva.add_argument(
         "--up_or_down",
         type=str,
-        default="true",
-        choices=["up", "down"],
-        help="Whether to look for up or down outliers. Choices are up or down. Default up.",
+        default="up",
+        choices=["up", "down", "both"],
+        help="Whether to look for up or down outliers. Choices are up, down or both. With both, "
+             "gene lists and heatmaps are prefixed with the direction. Default up.",
     )
     deva.add_argument(
         "--do_not_aggregate",
@@ -446,6 +561,48 @@ def _make_parser():
              "have a line with 'value    color' format for each value in annotations. Any value "
              "not represented will be assigned a new color. ",
     )
+    deva.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use when calculating row medians and IQRs and running "
+             "comparisons. -1 uses all cores. Default 1.",
+    )
+    deva.add_argument(
+        "--dtype",
+        type=str,
+        default="float64",
+        choices=value_dtypes,
+        help="Float type to read values and call outliers in. float32 roughly halves memory "
+             "use and stores counts in the smallest integer type that fits. Values within "
+             "float32 rounding of an outlier bound can be called differently. Default float64.",
+    )
+    deva.add_argument(
+        "--approximate",
+        default=False,
+        action="store_true",
+        help="Use flag to estimate row medians and IQRs from a quantile sketch of each row "
+             "instead of calculating them exactly. The values are still read into memory. "
+             "With the numpy backend the sketch uses less extra memory than exact statistics "
+             "but is slower; with the numba backend it uses more memory but is faster on wide "
+             "tables. The number of calls that could change with exact statistics is logged. ",
+    )
+    deva.add_argument(
+        "--sketch_size",
+        type=_check_positive_int,
+        default=1024,
+        help="Number of values per row in each level of the sketch with --approximate. Ranks "
+             "of estimates are off by at most about values * log2(values / this) / (2 * this), "
+             "where values is the number of non-missing values in the row. Default 1024.",
+    )
+    deva.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Use flag to only recalculate rows whose values changed since the last run with "
+             "the same output prefix. Writes the outlier table and a manifest of row "
+             "hashes. q-values are always recalculated. ",
+    )
 
     simulations = subparsers.add_parser(
         "simulations",
@@ -506,7 +663,23 @@ def _make_parser():
 def _main(args: Optional[List[str]] = None):
     if args is None:
         args = sys.argv[1:]
-    args = _make_parser().parse_args(args)
+    parser = _make_parser()
+    args = parser.parse_args(args)
+    if args.which == "outliers_table" and args.reference_row_stats:
+        # Reference row stats are only compared to the values, nothing is recalculated
+        unused = [
+            flag
+            for flag, used in (
+                ("--chunksize", args.chunksize is not None),
+                ("--n_jobs", args.n_jobs != 1),
+                ("--write_row_stats", args.write_row_stats),
+                ("--approximate", args.approximate),
+                ("--incremental", args.incremental),
+            )
+            if used
+        ]
+        if unused:
+            parser.error("%s cannot be used with --reference_row_stats" % ", ".join(unused))
 
     logger = _set_up_logger(args.output_prefix)
 
@@ -514,17 +687,38 @@ def _main(args: Optional[List[str]] = None):
     for arg in vars(args):
         logger.info("Parameter %s: %s" % (arg, getattr(args, arg)))
 
-    if args.which == "outliers_table":
-        df = parsers.read_in_values(args.values)
+    if args.which == "outliers_table" and args.reference_row_stats:
+        recall_outliers(
+            parsers.read_in_values(args.values, dtype=args.dtype),
+            parsers.read_in_row_stats(args.reference_row_stats),
+            iqrs=args.iqrs if len(args.iqrs) > 1 else args.iqrs[0],
+            up_or_down=args.up_or_down,
+            aggregate=not args.do_not_aggregate,
+            save_outlier_table=True,
+            save_frac_table=args.write_frac_table,
+            output_prefix=args.output_prefix,
+            ind_sep=args.ind_sep,
+            dtype=args.dtype,
+        )
+
+    elif args.which == "outliers_table":
+        df = args.values if args.chunksize else parsers.read_in_values(args.values, dtype=args.dtype)
         make_outliers_table(
             df,
-            iqrs=args.iqrs,
+            iqrs=args.iqrs if len(args.iqrs) > 1 else args.iqrs[0],
             up_or_down=args.up_or_down,
-            aggregate=~args.do_not_aggregate,
+            aggregate=not args.do_not_aggregate,
             save_outlier_table=True,
             save_frac_table=args.write_frac_table,
             output_prefix=args.output_prefix,
             ind_sep=args.ind_sep,
+            chunksize=args.chunksize,
+            n_jobs=args.n_jobs,
+            save_row_stats=args.write_row_stats,
+            dtype=args.dtype,
+            approximate=args.approximate,
+            sketch_size=args.sketch_size,
+            incremental=args.incremental,
         )
 
     elif args.which == "binarize":
@@ -544,7 +738,7 @@ def _main(args: Optional[List[str]] = None):
         if args.ind_subset:
             with open(args.ind_subset, 'r') as fh:
                 ind_list = [i.strip() for i in fh.readlines()]
-                outliers.df = subset_by_genes(outliers.df, ind_list, args.ind_sep)
+                outliers = outliers.subset_by_genes(ind_list, args.ind_sep)
 
         annotations = parsers.read_in_values(args.annotations)
         qVals = compare_groups_outliers(
@@ -554,6 +748,10 @@ def _main(args: Optional[List[str]] = None):
             save_qvalues=True,
             output_prefix=args.output_prefix,
             save_comparison_summaries=args.write_comparison_summaries,
+            n_jobs=args.n_jobs,
+            test=args.test,
+            n_permutations=args.n_permutations,
+            seed=args.seed,
         )
         if args.write_gene_list:
             qVals.write_gene_lists(args.fdr, args.output_prefix)
@@ -607,39 +805,56 @@ def _main(args: Optional[List[str]] = None):
             )
 
     elif args.which == "deva":
-        df = parsers.read_in_values(args.values)
+        df = parsers.read_in_values(args.values, dtype=args.dtype)
         annotations = parsers.read_in_values(args.annotations)
         Outliers, qVals = deva(
             df,
             annotations,
-            iqrs=args.iqrs,
+            iqrs=args.iqrs if len(args.iqrs) > 1 else args.iqrs[0],
             frac_filter=args.frac_filter,
             up_or_down=args.up_or_down,
-            aggregate=~args.do_not_aggregate,
-            save_outlier_table=args.write_outlier_table,
+            aggregate=not args.do_not_aggregate,
+            save_outlier_table=args.write_outlier_table or args.incremental,
             save_frac_table=args.write_frac_table,
             save_qvalues=True,
             output_prefix=args.output_prefix,
             ind_sep=args.ind_sep,
             save_comparison_summaries=args.write_comparison_summaries,
+            n_jobs=args.n_jobs,
+            dtype=args.dtype,
+            approximate=args.approximate,
+            sketch_size=args.sketch_size,
+            incremental=args.incremental,
         )
-        if args.write_gene_list:
-            qVals.write_gene_lists(args.fdr, args.output_prefix)
-
-        if args.make_heatmaps:
-            for col_of_interest in qVals.df.columns:
-                plot_heatmap(
-                    annotations,
-                    qVals.df,
-                    col_of_interest,
-                    Outliers.frac_table,
-                    fdr=args.fdr,
-                    red_or_blue=args.red_or_blue,
-                    output_prefix=args.output_prefix,
-                    colors=args.annotation_colors,
-                    savefig=True,
-                )
-                plt.close()
+        if not isinstance(Outliers, list):
+            Outliers, qVals = [Outliers], [qVals]
+        prefixes = []
+        for outliers in Outliers:
+            prefix = args.output_prefix
+            if len(args.iqrs) > 1:
+                prefix = iqrs_prefix % (prefix, outliers.iqrs)
+            if args.up_or_down == both_directions:
+                prefix = "%s.%s" % (prefix, outliers.up_or_down)
+            prefixes.append(prefix)
+
+        for outliers, q_vals, prefix in zip(Outliers, qVals, prefixes):
+            if args.write_gene_list:
+                q_vals.write_gene_lists(args.fdr, prefix)
+
+            if args.make_heatmaps:
+                for col_of_interest in q_vals.df.columns:
+                    plot_heatmap(
+                        annotations,
+                        q_vals.df,
+                        col_of_interest,
+                        outliers.frac_table,
+                        fdr=args.fdr,
+                        red_or_blue=args.red_or_blue,
+                        output_prefix=prefix,
+                        colors=args.annotation_colors,
+                        savefig=True,
+                    )
+                    plt.close()
 
     elif args.which == "simulations":
         run_simulations(
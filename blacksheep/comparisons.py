@@ -1,21 +1,34 @@
 import logging
+import zlib
 from typing import List, Tuple, Iterable, Optional
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from pandas import Series
-import scipy.stats
 from statsmodels.stats.multitest import multipletests
+from blacksheep.classes import OutlierTable
+from blacksheep import _jit
+from blacksheep._fisher import _fisher_exact, _fisher_lookup
+from blacksheep._permutation import _permutation_pvalues
 from blacksheep._constants import *
 
 
 SampleList = List[str]
+totals_block_cells = 1 << 22
+GroupTotals = Tuple[np.ndarray, np.ndarray, np.ndarray]
+# Annotation column, label of each category or None if it is not tested, samples of each category
+Comparison = Tuple[str, List[Optional[str]], List[SampleList]]
+# Number of permutations and the entropy of the seed, or None for fisher tests
+Permutations = Optional[Tuple[int, int]]
 logger = logging.getLogger("cli")
 
 
 def get_sample_lists(
     annotations: DataFrame, col: str
 ) -> Tuple[Optional[str], Optional[SampleList], Optional[str], Optional[SampleList]]:
-    """Finds groupings of samples from an annotation DataFrame column.
+    """Finds groupings of samples from an annotation DataFrame column. Kept for callers of
+    the 2 category API; compare_groups_outliers uses get_category_lists, which also handles
+    columns with more categories.
 
     Args:
         annotations: A DataFrame with samples as the index and annotations as columns. Each
@@ -27,172 +40,311 @@ def get_sample_lists(
         of samples in group1.
 
     """
-
-    groups = list(pd.Series(annotations[col].value_counts().keys()).dropna())
-    if len(groups) != 2:
+    categories, groups = get_category_lists(annotations, col)
+    if len(categories) != 2:
         return None, None, None, None
-    group0 = list(annotations.loc[annotations[col] == groups[0], :].index)
-    group1 = list(annotations.loc[annotations[col] == groups[1], :].index)
-    return groups[0], group0, groups[1], group1
+    return categories[0], groups[0], categories[1], groups[1]
+
+
+def get_category_lists(annotations: DataFrame, col: str) -> Tuple[list, List[SampleList]]:
+    """Finds the samples in each category of an annotation DataFrame column.
+
+    Args:
+        annotations: A DataFrame with samples as the index and annotations as columns.
+        col: Which column for which to define groups.
+
+    Returns: The categories, from most to least common, and the list of samples in each.
+
+    """
+    categories = list(pd.Series(annotations[col].value_counts().keys()).dropna())
+    groups = [
+        list(annotations.loc[annotations[col] == category, :].index) for category in categories
+    ]
+    return categories, groups
+
+
+def _comparison_pairs(comparison: Comparison) -> List[Tuple[str, int, str, str]]:
+    """Lists the groups that are tested against the rest of their annotation column. Columns
+    with 2 categories test the first category against the second, and columns with more test
+    each category against the other samples, named as in binarize_annotations.
+
+    Args:
+        comparison: Annotation column, category labels and groups, see _run_comparisons.
+
+    Returns: Name of the comparison, position of the category, label of the category and label
+    of the rest, for each tested category.
+
+    """
+    comp, labels, groups = comparison
+    if len(groups) == 2:
+        return [(comp, 0, labels[0], labels[1])]
+    return [
+        (binarized_col_name % (comp, label), position, label, outgroup_val % label)
+        for position, label in enumerate(labels)
+        if label is not None
+    ]
+
+
+class _QValueCollector:
+    """Collects q-value columns into one preallocated array with a row for each row of an
+    OutlierTable and a column for each possible comparison label, so the qvalues DataFrame is
+    only built once."""
+
+    def __init__(self, index: pd.Index, labels: List[str]):
+        """Preallocates the q-value array.
+
+        Args:
+            index: Row labels of the OutlierTable.
+            labels: Every column that could be added, in output order.
+        """
+        self.index = index
+        self.labels = labels
+        self.values = np.full((len(index), len(labels)), np.nan)
+        self.added = np.zeros(len(labels), dtype=bool)
+        self._columns = {label: column for column, label in enumerate(labels)}
+
+    def add(self, col: Series):
+        """Writes a q-value column, named by its label, into its rows.
+
+        Args:
+            col: q-values of the tested rows, named by comparison label.
+
+        Returns: None
+
+        """
+        column = self._columns[col.name]
+        self.values[self.index.get_indexer(col.index), column] = col.to_numpy()
+        self.added[column] = True
+
+    def to_frame(self) -> DataFrame:
+        """Builds the qvalues DataFrame from the added columns, without rows that were not
+        tested in any comparison."""
+        values = self.values[:, self.added]
+        tested = ~np.isnan(values).all(axis=1)
+        return DataFrame(
+            values[tested],
+            index=self.index[tested],
+            columns=[label for label, added in zip(self.labels, self.added) if added],
+        )
+
+
+def _group_indicator(groups: List[SampleList], samples: Iterable[str]) -> np.ndarray:
+    """Encodes groups of samples as an indicator matrix, so totals for every group can be
+    summed with one matrix product.
+
+    Args:
+        groups: Lists of samples, all of which must be in samples.
+        samples: Samples of the OutlierTable, in order.
+
+    Returns: Array with a row for each sample and a column for each group, 1 where the sample
+    is in the group and 0 elsewhere.
+
+    """
+    samples = pd.Index(samples)
+    indicator = np.zeros((len(samples), len(groups)))
+    for column, group in enumerate(groups):
+        indicator[samples.get_indexer(group), column] = 1
+    return indicator
 
 
 def _filter_outliers(
-    df: DataFrame,
-    group0_list: SampleList,
-    group1_list: SampleList,
+    totals0: GroupTotals,
+    totals1: GroupTotals,
+    n_group0: int,
     frac_filter: Optional[float],
-) -> DataFrame:
-    """Filters an outlier count table for rows that are enriched for outliers in group0 and that
-    have more than a frac_filter fraction of samples of group0 with an outlier.
+) -> np.ndarray:
+    """Filters rows for those that are enriched for outliers in group0 and that have more than a
+    frac_filter fraction of samples of group0 with an outlier.
 
     Args:
-        df: Outliers count table, output from convertToCounts. Samples are columns,
-        genes/sites are the index.
-        group0_list: List of samples in the group of interest.
-        group1_list: List of samples in the outgroup.
+        totals0: Outliers, non-missing values and samples with an outlier in the group of \
+        interest for each row, from OutlierTable.indicator_totals.
+        totals1: The same totals for the outgroup.
+        n_group0: Number of samples in the group of interest.
         frac_filter: The fraction of samples in group0 (i.e. the group of interest) that must
         have an outlier value to be considered in the comparison. Float between 0 and 1 or None.
 
-    Returns: A DataFrame with rows that are not enriched in group0 removed. If frac_filter > 0,
-    rows without enough outliers in group0 are also removed.
+    Returns: A boolean array that is False for rows that are not enriched in group0. If
+    frac_filter > 0, rows without enough outliers in group0 are also False.
 
     """
-    df = df.copy()
-    group0_outliers = [x + col_seps + col_outlier_suffix for x in group0_list]
-    group0_notOutliers = [x + col_seps + col_not_outlier_suffix for x in group0_list]
-    group1_outliers = [x + col_seps + col_outlier_suffix for x in group1_list]
-    group1_notOutliers = [x + col_seps + col_not_outlier_suffix for x in group1_list]
-
-    if (frac_filter < 0) or (frac_filter > 1):
+    if (frac_filter is not None) and ((frac_filter < 0) or (frac_filter > 1)):
         raise ValueError("Frac filter must be between 0 and 1")
-    if frac_filter != None:
-        min_num_outlier_samps = len(group0_list) * frac_filter
-        num_outlier_samps = (df[group0_outliers] > 0).sum(axis=1)
-        df = df.loc[num_outlier_samps >= min_num_outlier_samps, :]
-
-    # Filter for higher proportion of outliers in group0 than group1
-    group0_outlier_rate = (
-        df[group0_outliers]
-        .sum(axis=1)
-        .divide(df[group0_outliers + group0_notOutliers].sum(axis=1), axis=0)
-    )
-    group1_outlier_rate = (
-        df[group1_outliers]
-        .sum(axis=1)
-        .divide(df[group1_outliers + group1_notOutliers].sum(axis=1), axis=0)
-    )
+    outliers0, valid0, num_outlier_samps = totals0
+    outliers1, valid1, _ = totals1
 
-    df = df.loc[group0_outlier_rate > group1_outlier_rate, :]
+    # Filter for higher proportion of outliers in group0 than group1. Comparing cross products
+    # of the integer totals is the same as comparing rates, and is False where a group has no
+    # values, without making float copies.
+    keep = outliers0 * valid1 > outliers1 * valid0
+    if frac_filter is not None:
+        min_num_outlier_samps = n_group0 * frac_filter
+        keep &= num_outlier_samps >= min_num_outlier_samps
+    return keep
 
-    return df
+
+def _count_table(
+    totals0: GroupTotals, totals1: GroupTotals, outliers: OutlierTable, rows: np.ndarray
+) -> DataFrame:
+    """Table of the outlier and not outlier counts of both groups in the tested rows, see
+    _fisher_test_groups."""
+    outliers0, valid0 = totals0[0][rows], totals0[1][rows]
+    outliers1, valid1 = totals1[0][rows], totals1[1][rows]
+    return DataFrame(
+        {
+            outlier_count_lab + general_group_label_0: outliers0,
+            outlier_count_lab + general_group_label_1: outliers1,
+            not_outlier_count_lab + general_group_label_0: valid0 - outliers0,
+            not_outlier_count_lab + general_group_label_1: valid1 - outliers1,
+        },
+        index=outliers.index[rows],
+    )
 
 
 def _fisher_test_groups(
-    group0_list: SampleList,
-    group1_list: SampleList,
-    outlier_table: DataFrame,
+    totals0: GroupTotals,
+    totals1: GroupTotals,
+    outliers: OutlierTable,
+    rows: np.ndarray,
     correction_type: str = mult_hypoth_method,
+    backend: str = "numpy",
 ) -> Tuple[Series, DataFrame]:
     """Performs fishers test by counting outlier and not outlier sites in two groups. Corrects for
     multiple hypothesis testing.
 
     Args:
-        group0_list: List of samples in group of interest
-        group1_list: List of samples in outgroup
-        outlier_table: Outlier count table, like output of convertToCounts
+        totals0: Totals for the group of interest, from OutlierTable.indicator_totals.
+        totals1: Totals for the outgroup.
+        outliers: OutlierTable the totals were summed from.
+        rows: Boolean array of which rows to test, like output of _filter_outliers
         correction_type: Method to use for multiple hypothesis correction.
+        backend: "numpy" or "numba", from _get_backend. numpy tests every row at once from a \
+        table of log-factorials; numba uses a compiled test. Both agree with scipy's \
+        fisher_exact to about 1e-10 (relative). Tables that are not aggregated read \
+        p-values from cached grids for each pair of group sizes instead.
 
-    Returns: Series of qvalues with index matching filtered rows.
+    Returns: Series of qvalues with index matching filtered rows, and a table with the counts \
+    in each fisher table and the pvalues.
 
     """
-
-    outliers_group0_list = [x + col_seps + col_outlier_suffix for x in group0_list]
-    notOutliers_group0_list = [
-        x + col_seps + col_not_outlier_suffix for x in group0_list
-    ]
-    outliers_group1_list = [x + col_seps + col_outlier_suffix for x in group1_list]
-    notOutliers_group1_list = [
-        x + col_seps + col_not_outlier_suffix for x in group1_list
+    fisher_info = _count_table(totals0, totals1, outliers, rows)
+    outliers0, outliers1, not_outliers0, not_outliers1 = [
+        fisher_info[col].to_numpy() for col in fisher_info.columns
     ]
+    if not outliers.aggregated:
+        # Site-level margins are bounded by the group sizes, so there are few distinct tables
+        fisher_info[fisherp_col] = _fisher_lookup(
+            outliers0, outliers1, not_outliers0, not_outliers1
+        )
+    elif backend == "numba":
+        fisher_info[fisherp_col] = _jit._fisher_kernel(
+            *[
+                np.asarray(counts, dtype=np.int64)
+                for counts in (outliers0, outliers1, not_outliers0, not_outliers1)
+            ]
+        )
+    else:
+        fisher_info[fisherp_col] = _fisher_exact(
+            outliers0, outliers1, not_outliers0, not_outliers1
+        )
 
-    outlier_table[outlier_count_lab + general_group_label_0] = outlier_table[
-        outliers_group0_list
-    ].sum(axis=1)
-    outlier_table[not_outlier_count_lab + general_group_label_0] = outlier_table[
-        notOutliers_group0_list
-    ].sum(axis=1)
-    outlier_table[outlier_count_lab + general_group_label_1] = outlier_table[
-        outliers_group1_list
-    ].sum(axis=1)
-    outlier_table[not_outlier_count_lab + general_group_label_1] = outlier_table[
-        notOutliers_group1_list
-    ].sum(axis=1)
-
-    outlier_table[fisherp_col] = outlier_table.apply(
-        (
-            lambda r: scipy.stats.fisher_exact(
-                [
-                    [
-                        r[outlier_count_lab + general_group_label_0],
-                        r[outlier_count_lab + general_group_label_1],
-                    ],
-                    [
-                        r[not_outlier_count_lab + general_group_label_0],
-                        r[not_outlier_count_lab + general_group_label_1],
-                    ],
-                ]
-            )[1]
-        ),
-        axis=1,
-    )
+    fdr = multipletests(list(fisher_info[fisherp_col]), method=correction_type)[1]
+    return Series(fdr, index=fisher_info.index, name=fisherfdr_col), fisher_info
 
-    outlier_table[fisherfdr_col] = multipletests(
-        list(outlier_table[fisherp_col]), method=correction_type
-    )[1]
-    fisher_info = outlier_table[
-        [
-            outlier_count_lab + general_group_label_0,
-            outlier_count_lab + general_group_label_1,
-            not_outlier_count_lab + general_group_label_0,
-            not_outlier_count_lab + general_group_label_1,
-            fisherp_col,
-        ]
-    ]
-    return outlier_table[fisherfdr_col], fisher_info
+
+def _permutation_test_groups(
+    totals0: GroupTotals,
+    totals1: GroupTotals,
+    outliers: OutlierTable,
+    rows: np.ndarray,
+    group0: SampleList,
+    group1: SampleList,
+    n_permutations: int,
+    rng: np.random.Generator,
+    correction_type: str = mult_hypoth_method,
+) -> Tuple[Series, DataFrame]:
+    """Performs permutation tests of sample labels for a higher outlier rate in group0 than in
+    group1, instead of fisher tests. Sites of a gene stay with their sample, so they are not
+    treated as independent. Corrects for multiple hypothesis testing.
+
+    Args:
+        totals0: Totals for the group of interest, from OutlierTable.indicator_totals.
+        totals1: Totals for the outgroup.
+        outliers: OutlierTable the totals were summed from.
+        rows: Boolean array of which rows to test, like output of _filter_outliers
+        group0: Samples in the group of interest.
+        group1: Samples in the outgroup.
+        n_permutations: Maximum number of permutations for each row.
+        rng: Random number generator for the permutations.
+        correction_type: Method to use for multiple hypothesis correction.
+
+    Returns: Series of qvalues with index matching filtered rows, and a table with the counts \
+    of each group and the pvalues, in the same columns as _fisher_test_groups.
+
+    """
+    fisher_info = _count_table(totals0, totals1, outliers, rows)
+    outlier_counts, valid_counts = outliers.row_counts(rows)
+    columns = pd.Index(outliers.samples).get_indexer(group0 + group1)
+    fisher_info[fisherp_col], _ = _permutation_pvalues(
+        outlier_counts[:, columns],
+        valid_counts[:, columns],
+        np.arange(len(columns)) < len(group0),
+        n_permutations,
+        rng,
+    )
+    fdr = multipletests(list(fisher_info[fisherp_col]), method=correction_type)[1]
+    return Series(fdr, index=fisher_info.index, name=fisherfdr_col), fisher_info
 
 
 def _compare_groups(
-    results_df: DataFrame,
-    outliers: DataFrame,
+    outliers: OutlierTable,
+    totals0: GroupTotals,
+    totals1: GroupTotals,
     group0: SampleList,
     group1: SampleList,
     frac_filter: Optional[float],
     label: str,
-) -> Tuple[DataFrame, Optional[DataFrame]]:
+    backend: str = "numpy",
+    permutations: Permutations = None,
+) -> Tuple[Optional[Series], DataFrame]:
     """Performs fisher test and cleans up a fisher infor table for making output for each comparison
 
     Args:
-        results_df: Accumulating qvalues DataFrame
-        outliers: Outliers count DataFrame
-        group0: List of samples in group of interest
-        group1: List of samples in outgroup
+        outliers: OutlierTable the totals were summed from
+        totals0: Totals for the group of interest, from OutlierTable.indicator_totals
+        totals1: Totals for the outgroup
+        group0: Samples in the group of interest
+        group1: Samples in the outgroup
         frac_filter: Fraction of samples in group of interest require to have an outlier per
     site to be considered in analysis
         label: What to call the FDR output column on the qvalues DataFrame
+        backend: "numpy" or "numba", from _get_backend.
+        permutations: Number of permutations and seed entropy to run permutation tests \
+        instead of fisher tests. Permutations are seeded by the entropy and label, so they do \
+        not depend on the other comparisons.
 
-    Returns: Concatenated qvalues DataFrame and a table of info about the comparison
+    Returns: qvalues named label for the tested rows, or None if no rows were tested, and a \
+    table of info about the comparison
 
     """
 
-    df = _filter_outliers(outliers, group0, group1, frac_filter)
-    logger.info("Calculating enrichment in %s rows for %s" % (len(df), label))
-    if len(df) > 0:
-        col, fisher_info = _fisher_test_groups(group0, group1, df)
-        col = DataFrame(col)
-        col.columns = [label]
-        results_df = pd.concat([results_df, col], axis=1, join="outer", sort=False)
+    rows = _filter_outliers(totals0, totals1, len(group0), frac_filter)
+    logger.info("Calculating enrichment in %s rows for %s" % (rows.sum(), label))
+    if rows.any() and permutations is not None:
+        n_permutations, entropy = permutations
+        rng = np.random.default_rng([entropy, zlib.crc32(label.encode())])
+        col, fisher_info = _permutation_test_groups(
+            totals0, totals1, outliers, rows, group0, group1, n_permutations, rng
+        )
+        col = col.rename(label)
+    elif rows.any():
+        col, fisher_info = _fisher_test_groups(
+            totals0, totals1, outliers, rows, backend=backend
+        )
+        col = col.rename(label)
     else:
         logger.warning("No rows tested for %s" % label)
+        col = None
         fisher_info = DataFrame(
             columns=[
                 outlier_count_lab + general_group_label_0,
@@ -202,4 +354,102 @@ def _compare_groups(
                 fisherp_col,
             ]
         )
-    return results_df, fisher_info
+    return col, fisher_info
+
+
+def _run_comparisons(
+    outliers: OutlierTable,
+    comparisons: List[Comparison],
+    frac_filter: Optional[float],
+    backend: str = "numpy",
+    permutations: Permutations = None,
+) -> List[Tuple[Optional[Series], DataFrame]]:
+    """Tests each category of each annotation column against the rest of the column, and the
+    rest against the category. Totals for every category of a block of columns come from one
+    product of the counts with a group indicator matrix, and totals of the rest are the
+    column's total minus the category's.
+
+    Args:
+        outliers: OutlierTable with outlier and non-missing value count matrices
+        comparisons: (annotation column, category labels, groups) for each column, with \
+        every group in the table. Categories labelled None are only counted in the rest. \
+        Columns with 2 categories are tested once, see _comparison_pairs.
+        frac_filter: Fraction of samples in group of interest require to have an outlier per
+    site to be considered in analysis
+        backend: "numpy" or "numba", from _get_backend.
+        permutations: Number of permutations and seed entropy for permutation tests, or None \
+        for fisher tests.
+
+    Returns: Output of _compare_groups for the category then the rest of each comparison pair, \
+    in order
+
+    """
+    # Totals are summed for a block of columns at a time, so memory depends on the block
+    # rather than the number of annotation columns. The table-sized operands of the product
+    # are cast once per table by indicator_totals, so blocks do not copy the table
+    block_groups = max(totals_block_cells // max(len(outliers.index), 1), 1)
+    results = []
+    start = 0
+    while start < len(comparisons):
+        stop, n_groups = start, 0
+        while stop < len(comparisons) and (
+            stop == start or n_groups + len(comparisons[stop][2]) <= block_groups
+        ):
+            n_groups += len(comparisons[stop][2])
+            stop += 1
+        block = comparisons[start:stop]
+        indicator = _group_indicator(
+            [group for _, _, groups in block for group in groups], outliers.samples
+        )
+        results.extend(
+            _run_comparison_block(
+                outliers,
+                block,
+                outliers.indicator_totals(indicator),
+                frac_filter,
+                backend,
+                permutations,
+            )
+        )
+        start = stop
+    return results
+
+
+def _run_comparison_block(
+    outliers: OutlierTable,
+    comparisons: List[Comparison],
+    all_totals: GroupTotals,
+    frac_filter: Optional[float],
+    backend: str = "numpy",
+    permutations: Permutations = None,
+) -> List[Tuple[Optional[Series], DataFrame]]:
+    """Runs comparisons from their totals, with a column for each category of each annotation
+    column, see _run_comparisons."""
+    results = []
+    offset = 0
+    for comparison in comparisons:
+        comp, _, groups = comparison
+        logger.info("Testing for enrichment in %s comparison" % comp)
+        category_totals = [totals[:, offset:offset + len(groups)] for totals in all_totals]
+        column_totals = [totals.sum(axis=1) for totals in category_totals]
+        offset += len(groups)
+        for name, position, label, rest_label in _comparison_pairs(comparison):
+            totals0 = tuple(totals[:, position] for totals in category_totals)
+            totals1 = tuple(total - totals for total, totals in zip(column_totals, totals0))
+            group0 = groups[position]
+            group1 = [
+                samp for other, group in enumerate(groups) if other != position for samp in group
+            ]
+            results.append(
+                _compare_groups(
+                    outliers, totals0, totals1, group0, group1, frac_filter,
+                    fdr_col_label % (name, label), backend, permutations,
+                )
+            )
+            results.append(
+                _compare_groups(
+                    outliers, totals1, totals0, group1, group0, frac_filter,
+                    fdr_col_label % (name, rest_label), backend, permutations,
+                )
+            )
+    return results
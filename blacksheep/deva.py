@@ -1,36 +1,586 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union, Iterable, Iterator
+import hashlib
+import itertools
 import logging
 import os.path
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
-from blacksheep.parsers import subset_by_genes
-from blacksheep.classes import OutlierTable, qValues
-from blacksheep._outlierTable import _convert_to_outliers
+from blacksheep.parsers import subset_by_genes, read_in_values, read_in_row_stats
+from blacksheep.parsers import _as_values_frame
+from blacksheep.classes import OutlierTable, OrderedOutlierTable, qValues, _counts_from_df
+from blacksheep._outlierTable import _calculate_row_stats
+from blacksheep._outlierTable import _call_outliers
 from blacksheep._outlierTable import _convert_to_counts
-from blacksheep.comparisons import _compare_groups
-from blacksheep.comparisons import get_sample_lists
+from blacksheep._outlierTable import _group_index
+from blacksheep._outlierTable import _make_row_stats
+from blacksheep._outlierTable import _get_count_dtype
+from blacksheep._outlierTable import _pack_mask
+from blacksheep._parallel import _parallel_row_stats, _parallel_comparisons, _get_n_jobs
+from blacksheep._sketch import _sketch_row_stats, _uncertain_calls
+from blacksheep._jit import _get_backend
+from blacksheep.comparisons import _run_comparisons, _QValueCollector
+from blacksheep.comparisons import get_category_lists, _comparison_pairs
 from blacksheep._constants import *
 
 
-def make_outliers_table(
+def _save_outliers_table(
+    outliers: OutlierTable,
+    save_outlier_table: bool,
+    save_frac_table: bool,
+    output_prefix: str,
+    append: bool = False,
+):
+    """Writes the count and fraction tables of an OutlierTable, if requested.
+
+    Args:
+        outliers: OutlierTable to write.
+        save_outlier_table: Whether to write a file with the outlier count table.
+        save_frac_table: Whether to write a file with the outlier fraction table.
+        output_prefix: A prefix for the files.
+        append: Whether to add rows to the end of existing files, without a header, instead of \
+        overwriting them.
+
+    Returns: None
+
+    """
+    mode = "a" if append else "w"
+    if save_frac_table:
+        frac_path = os.path.abspath(
+            frac_table_file_name % (output_prefix, outliers.up_or_down)
+        )
+        logging.info("Saving outlier fraction table to %s" % frac_path)
+        outliers.frac_table.to_csv(frac_path, sep="\t", mode=mode, header=not append)
+
+    if save_outlier_table:
+        out_path = os.path.abspath(
+            outlier_table_file_name % (output_prefix, outliers.up_or_down)
+        )
+        logging.info("Saving outlier table to %s" % out_path)
+        outliers.df.to_csv(out_path, sep="\t", mode=mode, header=not append)
+
+
+def _save_row_stats(
+    outliers_tables: List[OutlierTable], output_prefix: str, sweep: bool, append: bool = False
+):
+    """Writes the row medians, IQRs and outlier bounds used to make OutlierTables, once for each
+    IQR threshold.
+
+    Args:
+        outliers_tables: OutlierTables with row_stats.
+        output_prefix: A prefix for the files.
+        sweep: Whether several IQR thresholds are being written.
+        append: Whether to add rows to the end of existing files, without a header, instead of \
+        overwriting them.
+
+    Returns: None
+
+    """
+    written = set()
+    for outliers in outliers_tables:
+        stats_path = os.path.abspath(
+            row_stats_file_name % _get_table_prefix(output_prefix, outliers, sweep)
+        )
+        if stats_path in written:
+            continue
+        logging.info("Saving row statistics to %s" % stats_path)
+        outliers.row_stats.to_csv(
+            stats_path, sep="\t", mode="a" if append else "w", header=not append
+        )
+        written.add(stats_path)
+
+
+def _get_directions(up_or_down: str) -> List[str]:
+    """Checks up_or_down and lists the directions to call outliers in.
+
+    Args:
+        up_or_down: "up", "down" or "both"
+
+    Returns: List of directions
+
+    """
+    if up_or_down == both_directions:
+        return directions
+    if up_or_down in directions:
+        return [up_or_down]
+    raise ValueError("up_or_down must be either 'up', 'down' or 'both'")
+
+
+def _get_iqrs(iqrs: Union[float, Iterable[float]]) -> List[float]:
+    """Checks iqrs and lists the IQR thresholds to call outliers at.
+
+    Args:
+        iqrs: A number of IQRs, or several
+
+    Returns: List of IQR thresholds
+
+    """
+    iqrs_list = list(iqrs) if np.iterable(iqrs) else [iqrs]
+    if (len(iqrs_list) == 0) or any(num_iqrs <= 0 for num_iqrs in iqrs_list):
+        raise ValueError("num_iqrs must be greater than 0")
+    return iqrs_list
+
+
+def _get_dtype(dtype: str) -> np.dtype:
+    """Checks the values dtype.
+
+    Args:
+        dtype: Name of a float type in value_dtypes
+
+    Returns: The numpy dtype
+
+    """
+    if dtype not in value_dtypes:
+        raise ValueError("dtype must be one of %s" % ", ".join(value_dtypes))
+    return np.dtype(dtype)
+
+
+def _get_table_prefix(output_prefix: str, outliers: OutlierTable, sweep: bool) -> str:
+    """Adds the IQR threshold to an output prefix when tables for several thresholds are made.
+
+    Args:
+        output_prefix: Output prefix
+        outliers: OutlierTable that will be written
+        sweep: Whether several IQR thresholds are being written
+
+    Returns: Output prefix for this table
+
+    """
+    if sweep:
+        return iqrs_prefix % (output_prefix, outliers.iqrs)
+    return output_prefix
+
+
+def _make_outliers_tables(
     df: DataFrame,
-    iqrs: float = 1.5,
+    iqrs: List[float],
+    to_call: List[str],
+    aggregate: bool,
+    ind_sep: str,
+    n_jobs: int = 1,
+    row_stats: Optional[DataFrame] = None,
+    dtype: np.dtype = np.dtype("float64"),
+    sketch_size: Optional[int] = None,
+    backend: str = "numpy",
+) -> List[OutlierTable]:
+    """Calculates row statistics once and makes an OutlierTable for each IQR threshold and
+    direction.
+
+    Args:
+        df: Input DataFrame with samples as columns and sites/genes as rows.
+        iqrs: The numbers of IQRs above or below the median to consider a value as an outlier.
+        to_call: Directions to call outliers in.
+        aggregate: Whether to sum outliers per gene.
+        ind_sep: The separator used in sites to separate a gene and site.
+        n_jobs: Number of processes to calculate row statistics with.
+        row_stats: Stored row medians and IQRs, in the same row order as df. If given, these \
+        are used instead of calculating them.
+        dtype: Float type to calculate in. Types smaller than float64 also use the smallest \
+        integer type that fits for the counts.
+        sketch_size: If given, row medians and IQRs are estimated from a quantile sketch \
+        keeping this many values per row in each level, and the number of calls per row that \
+        could change with the exact statistics is added to the row statistics.
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns: List of OutlierTables, for each threshold in iqrs and each direction in to_call
+
+    """
+    samples = df.columns
+    values = df.to_numpy(dtype=dtype)
+    valid_mask = ~np.isnan(values)
+    group_codes, groups = _group_index(df.index, ind_sep)
+    counts_dtype = _get_count_dtype(group_codes, aggregate, dtype.itemsize < 8)
+    if row_stats is not None:
+        row_median = row_stats[row_median_name].to_numpy(dtype=np.float64)
+        row_iqr = row_stats[row_iqr_name].to_numpy(dtype=np.float64)
+    elif sketch_size is not None:
+        row_median, row_iqr, median_interval, iqr_interval = _sketch_row_stats(
+            values, sketch_size
+        )
+    elif n_jobs > 1 and len(values) > 1:
+        row_median, row_iqr = _parallel_row_stats(values, n_jobs, backend)
+    else:
+        row_median, row_iqr = _calculate_row_stats(values, backend)
+
+    # Site-level counts are all 0 or 1, so they are kept as packed bits
+    valid_bits = None if aggregate else _pack_mask(valid_mask)
+    outliers_tables = []
+    for num_iqrs, direction in itertools.product(iqrs, to_call):
+        outlier_mask = _call_outliers(
+            values, row_median, row_iqr, num_iqrs, direction, backend
+        )
+        if aggregate:
+            outlier_counts, valid_counts, index = _convert_to_counts(
+                outlier_mask,
+                valid_mask,
+                df.index,
+                aggregate,
+                group_codes,
+                groups,
+                counts_dtype,
+                backend,
+            )
+            outlier_bits = None
+        else:
+            outlier_counts, valid_counts, index = None, None, df.index
+            outlier_bits = _pack_mask(outlier_mask)
+        table_row_stats = _make_row_stats(df.index, row_median, row_iqr, num_iqrs)
+        if sketch_size is not None:
+            uncertain = _uncertain_calls(
+                values, median_interval, iqr_interval, num_iqrs, direction
+            )
+            table_row_stats[row_uncertain_name] = uncertain
+            logging.info(
+                "Approximate %s outliers at %s IQRs: %s of %s calls could change"
+                % (direction, num_iqrs, uncertain.sum(), valid_mask.sum())
+            )
+        outliers_tables.append(
+            OutlierTable(
+                None,
+                direction,
+                num_iqrs,
+                samples,
+                None,
+                outlier_counts=outlier_counts,
+                valid_counts=valid_counts,
+                index=index,
+                aggregated=aggregate,
+                group_codes=group_codes,
+                groups=groups,
+                row_stats=table_row_stats,
+                outlier_bits=outlier_bits,
+                valid_bits=valid_bits,
+                bits_dtype=counts_dtype,
+            )
+        )
+    return outliers_tables
+
+
+def _finish_outliers_tables(
+    outliers_tables: List[OutlierTable],
+    save_outlier_table: bool,
+    save_frac_table: bool,
+    save_row_stats: bool,
+    output_prefix: str,
+    sweep: bool,
+) -> Union[OutlierTable, List[OutlierTable]]:
+    """Writes any requested files for new OutlierTables and returns them.
+
+    Args:
+        outliers_tables: OutlierTables from _make_outliers_tables.
+        save_outlier_table: Whether to write a file with the outlier count table.
+        save_frac_table: Whether to write a file with the outlier fraction table.
+        save_row_stats: Whether to write a file with the row statistics.
+        output_prefix: A prefix for the files.
+        sweep: Whether several IQR thresholds were used.
+
+    Returns: The OutlierTable, or a list of OutlierTables if there is more than one.
+
+    """
+    for outliers in outliers_tables:
+        _save_outliers_table(
+            outliers,
+            save_outlier_table,
+            save_frac_table,
+            _get_table_prefix(output_prefix, outliers, sweep),
+        )
+    if save_row_stats:
+        _save_row_stats(outliers_tables, output_prefix, sweep)
+
+    if len(outliers_tables) > 1:
+        return outliers_tables
+    return outliers_tables[0]
+
+
+def _row_hashes(df: DataFrame, dtype: np.dtype, params: tuple) -> pd.Series:
+    """Hashes the values of each row, together with the samples and the parameters outliers are
+    called with, so a row's hash only stays the same if its calls would be the same.
+
+    Args:
+        df: Input DataFrame with samples as columns and sites/genes as rows.
+        dtype: Float type values are called in.
+        params: Parameters that change outlier calls, e.g. the IQR thresholds.
+
+    Returns: Hex digest of each row, indexed like df
+
+    """
+    seed = hashlib.blake2b(digest_size=16)
+    seed.update(repr(params).encode())
+    seed.update("\t".join(str(sample) for sample in df.columns).encode())
+    hashes = []
+    for row in np.ascontiguousarray(df.to_numpy(dtype=dtype)):
+        row_hash = seed.copy()
+        row_hash.update(row.tobytes())
+        hashes.append(row_hash.hexdigest())
+    return pd.Series(hashes, index=df.index, name=row_hash_name)
+
+
+def _update_outliers_tables(
+    df: DataFrame,
+    iqrs: List[float],
+    to_call: List[str],
+    aggregate: bool,
+    ind_sep: str,
+    output_prefix: str,
+    n_jobs: int = 1,
+    dtype: np.dtype = np.dtype("float64"),
+    sketch_size: Optional[int] = None,
+    backend: str = "numpy",
+) -> Tuple[List[OutlierTable], DataFrame]:
+    """Makes OutlierTables by recalculating only the rows whose values changed since the last
+    run with the same output prefix. Row statistics only depend on their own row, so the counts
+    of other rows are taken from the previous count tables. When aggregating, every row of a
+    gene with a changed, added or removed site is recalculated.
+
+    Args:
+        df: Input DataFrame with samples as columns and sites/genes as rows.
+        iqrs: The numbers of IQRs above or below the median to consider a value as an outlier.
+        to_call: Directions to call outliers in.
+        aggregate: Whether to sum outliers per gene.
+        ind_sep: The separator used in sites to separate a gene and site.
+        output_prefix: Prefix of the previous manifest and count tables.
+        n_jobs: Number of processes to calculate row statistics with.
+        dtype: Float type to calculate in.
+        sketch_size: Values per row in each sketch level if row statistics are estimated.
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns: List of OutlierTables, as from _make_outliers_tables, and the new manifest with \
+    the hash, median and IQR of each row.
+
+    """
+    row_hashes = _row_hashes(df, dtype, (iqrs, to_call, aggregate, ind_sep, sketch_size))
+    sweep = len(iqrs) > 1
+    table_paths = [
+        os.path.abspath(
+            outlier_table_file_name
+            % (iqrs_prefix % (output_prefix, num_iqrs) if sweep else output_prefix, direction)
+        )
+        for num_iqrs, direction in itertools.product(iqrs, to_call)
+    ]
+    manifest_path = os.path.abspath(manifest_file_name % output_prefix)
+    if os.path.exists(manifest_path) and all(os.path.exists(path) for path in table_paths):
+        manifest = read_in_row_stats(manifest_path)
+        changed = (manifest[row_hash_name].reindex(df.index) != row_hashes).to_numpy()
+    else:
+        logging.info("No previous manifest and count tables at %s" % output_prefix)
+        manifest, changed = None, np.ones(len(df), dtype=bool)
+
+    group_codes, groups = _group_index(df.index, ind_sep)
+    recalculate = changed
+    if aggregate and manifest is not None:
+        removed = _group_index(manifest.index.difference(df.index), ind_sep)[1]
+        changed_groups = groups[np.unique(group_codes[changed])].union(removed)
+        recalculate = groups.isin(changed_groups)[group_codes]
+    logging.info("Recalculating %s of %s rows" % (recalculate.sum(), len(df)))
+
+    if recalculate.all():
+        outliers_tables = _make_outliers_tables(
+            df, iqrs, to_call, aggregate, ind_sep, n_jobs, dtype=dtype,
+            sketch_size=sketch_size, backend=backend,
+        )
+        row_stats = outliers_tables[0].row_stats
+        manifest = pd.concat([row_hashes, row_stats[[row_median_name, row_iqr_name]]], axis=1)
+        return outliers_tables, manifest
+
+    row_median = manifest[row_median_name].reindex(df.index).to_numpy(dtype=np.float64)
+    row_iqr = manifest[row_iqr_name].reindex(df.index).to_numpy(dtype=np.float64)
+    new_tables = [None] * len(table_paths)
+    if recalculate.any():
+        new_tables = _make_outliers_tables(
+            df[recalculate], iqrs, to_call, aggregate, ind_sep, n_jobs, dtype=dtype,
+            sketch_size=sketch_size, backend=backend,
+        )
+        row_median[recalculate] = new_tables[0].row_stats[row_median_name]
+        row_iqr[recalculate] = new_tables[0].row_stats[row_iqr_name]
+
+    index = groups if aggregate else df.index
+    counts_dtype = _get_count_dtype(group_codes, aggregate, dtype.itemsize < 8)
+    outliers_tables = []
+    for (num_iqrs, direction), path, new in zip(
+        itertools.product(iqrs, to_call), table_paths, new_tables
+    ):
+        previous = read_in_values(path).reindex(index)
+        outlier_counts, valid_counts = _counts_from_df(previous, df.columns)
+        if new is not None:
+            rows = index.get_indexer(new.index)
+            outlier_counts[rows] = new.outlier_counts
+            valid_counts[rows] = new.valid_counts
+        outlier_bits = valid_bits = None
+        if not aggregate:
+            outlier_bits, valid_bits = _pack_mask(outlier_counts > 0), _pack_mask(valid_counts > 0)
+            outlier_counts = valid_counts = None
+        else:
+            outlier_counts = outlier_counts.astype(counts_dtype)
+            valid_counts = valid_counts.astype(counts_dtype)
+        outliers_tables.append(
+            OutlierTable(
+                None,
+                direction,
+                num_iqrs,
+                df.columns,
+                None,
+                outlier_counts=outlier_counts,
+                valid_counts=valid_counts,
+                index=index,
+                aggregated=aggregate,
+                group_codes=group_codes,
+                groups=groups,
+                row_stats=_make_row_stats(df.index, row_median, row_iqr, num_iqrs),
+                outlier_bits=outlier_bits,
+                valid_bits=valid_bits,
+                bits_dtype=counts_dtype,
+            )
+        )
+    manifest = DataFrame(
+        {row_hash_name: row_hashes, row_median_name: row_median, row_iqr_name: row_iqr},
+        index=df.index,
+    )
+    return outliers_tables, manifest
+
+
+def _complete_gene_blocks(chunks: Iterable[DataFrame], ind_sep: str) -> Iterator[DataFrame]:
+    """Re-splits blocks of rows so that the rows of a gene at the end of a block are moved into
+    the next block.
+
+    Args:
+        chunks: Blocks of rows from the values file.
+        ind_sep: The separator used in sites to separate a gene and site.
+
+    Returns: Iterator of DataFrames
+
+    """
+    held_back = None
+    for chunk in chunks:
+        if held_back is not None:
+            chunk = pd.concat([held_back, chunk])
+        if len(chunk) == 0:
+            continue
+        group_codes = _group_index(chunk.index, ind_sep)[0]
+        last_gene = group_codes == group_codes[-1]
+        held_back = chunk.loc[last_gene, :]
+        yield chunk.loc[~last_gene, :]
+    if held_back is not None:
+        yield held_back
+
+
+def _stream_outliers_tables(
+    path: str,
+    chunksize: int,
+    iqrs: List[float],
+    to_call: List[str],
+    aggregate: bool,
+    save_outlier_table: bool,
+    save_frac_table: bool,
+    output_prefix: str,
+    ind_sep: str,
+    n_jobs: int = 1,
+    save_row_stats: bool = False,
+    dtype: np.dtype = np.dtype("float64"),
+    sketch_size: Optional[int] = None,
+    backend: str = "numpy",
+):
+    """Calls outliers on a values file in blocks of rows and writes the count and fraction
+    tables as each block is finished. If aggregating, rows of the gene at the end of a block
+    are held back and counted with the next block, so the rows of a gene must be next to each
+    other in the file.
+
+    Args:
+        path: File path to values. Samples as columns, sites/genes as rows.
+        chunksize: Number of rows to read at a time.
+        iqrs: The numbers of IQRs above or below the median to consider a value as an outlier.
+        to_call: Directions to call outliers in.
+        aggregate: Whether to sum outliers per gene.
+        save_outlier_table: Whether to write a file with the outlier count table.
+        save_frac_table: Whether to write a file with the outlier fraction table.
+        output_prefix: A prefix for the files.
+        ind_sep: The separator used in sites to separate a gene and site.
+        n_jobs: Number of processes to calculate row statistics with.
+        save_row_stats: Whether to write a file with the row medians and IQRs.
+        dtype: Float type to read and calculate in.
+        sketch_size: If given, estimate row medians and IQRs from a quantile sketch with this \
+        many values per row in each level.
+        backend: "numpy" or "numba", from _get_backend.
+
+    Returns: None
+
+    """
+    if not (save_outlier_table or save_frac_table or save_row_stats):
+        raise ValueError(
+            "Streaming only writes outputs to files, "
+            "use save_outlier_table, save_frac_table or save_row_stats"
+        )
+
+    finished_genes = set()
+    appending = False
+    with read_in_values(path, chunksize=chunksize, dtype=dtype.name) as chunks:
+        if aggregate:
+            chunks = _complete_gene_blocks(chunks, ind_sep)
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            logging.info("Calling outliers for a block of %s rows" % len(chunk))
+            outliers_tables = _make_outliers_tables(
+                chunk, iqrs, to_call, aggregate, ind_sep, n_jobs, dtype=dtype,
+                sketch_size=sketch_size, backend=backend,
+            )
+            if aggregate:
+                repeated = finished_genes.intersection(outliers_tables[0].index)
+                if repeated:
+                    raise ValueError(
+                        "Rows for %s are not next to each other in %s. Sort the values file "
+                        "by row labels to aggregate while streaming." % (", ".join(repeated), path)
+                    )
+                finished_genes.update(outliers_tables[0].index)
+
+            for outliers in outliers_tables:
+                _save_outliers_table(
+                    outliers,
+                    save_outlier_table,
+                    save_frac_table,
+                    _get_table_prefix(output_prefix, outliers, len(iqrs) > 1),
+                    appending,
+                )
+            if save_row_stats:
+                _save_row_stats(outliers_tables, output_prefix, len(iqrs) > 1, appending)
+            appending = True
+
+
+def make_outliers_table(
+    df: Union[DataFrame, str, np.ndarray, "pyarrow.Table"],
+    iqrs: Union[float, Iterable[float]] = 1.5,
     up_or_down: str = "up",
     aggregate: bool = True,
     save_outlier_table: bool = False,
     save_frac_table: bool = False,
     output_prefix: str = "outliers",
     ind_sep: str = "-",
-) -> OutlierTable:
+    chunksize: Optional[int] = None,
+    n_jobs: int = 1,
+    save_row_stats: bool = False,
+    dtype: str = "float64",
+    approximate: bool = False,
+    sketch_size: int = 1024,
+    backend: Optional[str] = None,
+    row_labels: Optional[Union[Iterable, str]] = None,
+    sample_labels: Optional[Iterable] = None,
+    incremental: bool = False,
+) -> Union[OutlierTable, List[OutlierTable], None]:
     """Converts a DataFrame of values into an OutlierTable object, which includes a DataFrame
     of outlier and non-outlier count values.
 
     Args:
-        df: Input DataFrame with samples as columns and sites/genes as columns.
+        df: Input DataFrame with samples as columns and sites/genes as columns. Can also be a \
+        path to a .csv or .tsv file of values, a 2D numpy array (including memory-mapped \
+        arrays) with row_labels and sample_labels, or a pyarrow Table with a column per \
+        sample. Arrays whose type matches dtype are used without copying; pyarrow Tables are \
+        copied once into a matrix, column by column.
         iqrs: The number of inter-quartile ranges (IQRs) above or below the median to consider a \
-        value as an outlier.
+        value as an outlier. Can be a list of thresholds, in which case row medians and IQRs are \
+        calculated once and an OutlierTable is made for each threshold. Written files then \
+        have ".iqrs<threshold>" added to the output prefix.
         up_or_down: Whether to call up or down outliers. Up is above the median; down \
-        is below the median. Options "up" or "down".
+        is below the median. Options "up", "down" or "both". With "both", row medians and IQRs \
+        are calculated once and used to call up and down outliers.
         aggregate: Whether to sum outliers across a grouping (e.g. gene-level) than individual \
         sites. For instance if columns indicate phosphosites on proteins, with the format \
         "RAG2-S365", output will show counts of outliers per protein (e.g. RAG2) rather than on \
@@ -40,117 +590,370 @@ def make_outliers_table(
         output_prefix: If files are written, a prefix for the files.
         ind_sep: The separator used in sites, for instance, to separate a gene and site. \
         If just using genes (i.e. no separator), or not aggregating this parameter has no effect.
+        chunksize: If df is a file path, read and process this many rows at a time, writing \
+        the count and fraction tables as each block is done, so memory use depends on the \
+        chunksize rather than the file size. Rows of each gene must be next to each other in \
+        the file when aggregating. Outputs are only written to files in this mode.
+        n_jobs: Number of processes used to calculate row medians and IQRs. Rows are split \
+        across processes, which read the values from shared memory. -1 uses all cores.
+        save_row_stats: Whether to write a file with the median, IQR and outlier bounds of each \
+        row. The file can be given to recall_outliers to call outliers at other thresholds \
+        without recalculating them.
+        dtype: Float type to call outliers in, "float64" or "float32". float32 halves the \
+        memory used for values and stores counts as uint8 or uint16 (whichever fits the \
+        largest gene) and fractions as float32. Values are rounded to float32 when read, \
+        so values within float32 precision (about 1e-7 relative) of an outlier bound can be \
+        called differently than in float64. Medians and IQRs of the rounded values are kept \
+        in float64, so calls do not depend on n_jobs and are the same when re-called. \
+        Counts, and so q-values, can only differ for genes with such a value; all other \
+        q-values are identical to float64.
+        approximate: Whether to estimate row medians and IQRs from a mergeable quantile \
+        sketch of each row instead of calculating them exactly, for very wide tables. The \
+        sketch is built in one pass over blocks of samples and keeps about \
+        sketch_size * log2(values / sketch_size) of the non-missing values of each row. The \
+        values table itself is still read into memory. The numpy backend sorts a copy of \
+        the whole table for exact statistics, and the sketch needs well under half of that \
+        extra memory, but is slower. The numba backend finds exact statistics without \
+        copying the table, using less memory than the sketch, and is slower than the \
+        sketch on wide tables. Ranks of the estimates are off by at most about \
+        values * log2(values / sketch_size) / (2 * sketch_size), where values is the \
+        number of non-missing values in the row, whatever their spread. The number of \
+        calls per row that could be different with exact statistics is added to the row \
+        statistics as row_uncertainCalls, and the total is logged.
+        sketch_size: Number of values per row in each level of the sketch when approximate \
+        is used. Tables with at most this many samples are summarized exactly.
+        backend: Implementation of the row statistics, outlier calls and aggregation. Options \
+        "numpy", "numba" or "auto" (numba when it is installed). Default uses the \
+        BLACKSHEEP_BACKEND environment variable, or "auto" if it is not set.
+        row_labels: If df is a 2D array, the label of each row. If df is a pyarrow Table, the \
+        name of the column with row labels, or the labels themselves.
+        sample_labels: If df is a 2D array, the label of each column. If df is a pyarrow \
+        Table, which columns are samples; default is every column except the row labels.
+        incremental: Whether to reuse the outputs of an earlier run with the same \
+        output_prefix. A manifest with a hash, median and IQR of each row is written next to \
+        the count tables, and on later runs only rows whose hash changed (and, when \
+        aggregating, the other sites of their genes) are recalculated. Needs \
+        save_outlier_table. Any change to the samples or parameters recalculates every row.
 
     Returns: outliers
         Returns an OutlierTable object, with outlier and non-outlier counts and metadata
-        about how the outliers were called.
+        about how the outliers were called. If up_or_down is "both" or several iqrs are given,
+        returns a list of OutlierTables, ordered by threshold and then direction (up before
+        down). Returns None if chunksize is used.
 
     """
+    to_call = _get_directions(up_or_down)
+    iqrs_list = _get_iqrs(iqrs)
+    n_jobs = _get_n_jobs(n_jobs)
+    values_dtype = _get_dtype(dtype)
+    if approximate and sketch_size < 1:
+        raise ValueError("sketch_size must be at least 1")
+    sketch_size = sketch_size if approximate else None
+    backend = _get_backend(backend)
 
-    samples = df.columns
-    logging.info("Calling outliers for %s samples" % len(samples))
+    if incremental and not save_outlier_table:
+        raise ValueError("incremental needs save_outlier_table")
 
-    df = _convert_to_outliers(df, samples, iqrs, up_or_down)
-    df = _convert_to_counts(df, samples, aggregate, ind_sep)
-    outliers = OutlierTable(df, up_or_down, iqrs, samples, None)
+    if chunksize is not None:
+        if incremental:
+            raise ValueError("incremental can not be used with chunksize")
+        if not isinstance(df, str):
+            raise ValueError("chunksize can only be used when df is a file path")
+        _stream_outliers_tables(
+            df,
+            chunksize,
+            iqrs_list,
+            to_call,
+            aggregate,
+            save_outlier_table,
+            save_frac_table,
+            output_prefix,
+            ind_sep,
+            n_jobs,
+            save_row_stats,
+            values_dtype,
+            sketch_size,
+            backend,
+        )
+        return None
+    if isinstance(df, str):
+        df = read_in_values(df, dtype=dtype)
+    df = _as_values_frame(df, row_labels, sample_labels, dtype)
 
-    if save_frac_table:
-        frac_path = os.path.abspath(frac_table_file_name % (output_prefix, up_or_down))
-        logging.info("Saving outlier fraction table to %s" % frac_path)
-        outliers.frac_table.to_csv(frac_path, sep="\t")
+    logging.info("Calling outliers for %s samples" % len(df.columns))
+    if incremental:
+        outliers_tables, manifest = _update_outliers_tables(
+            df, iqrs_list, to_call, aggregate, ind_sep, output_prefix, n_jobs,
+            dtype=values_dtype, sketch_size=sketch_size, backend=backend,
+        )
+    else:
+        outliers_tables = _make_outliers_tables(
+            df, iqrs_list, to_call, aggregate, ind_sep, n_jobs, dtype=values_dtype,
+            sketch_size=sketch_size, backend=backend,
+        )
+    outliers = _finish_outliers_tables(
+        outliers_tables,
+        save_outlier_table,
+        save_frac_table,
+        save_row_stats,
+        output_prefix,
+        len(iqrs_list) > 1,
+    )
+    if incremental:
+        # Written after the count tables, so the manifest never describes tables that were
+        # not saved
+        manifest_path = os.path.abspath(manifest_file_name % output_prefix)
+        logging.info("Saving row manifest to %s" % manifest_path)
+        manifest.to_csv(manifest_path, sep="\t")
+    return outliers
 
-    if save_outlier_table:
-        out_path = os.path.abspath(
-            outlier_table_file_name % (output_prefix, up_or_down)
+
+def recall_outliers(
+    df: Union[DataFrame, str],
+    row_stats: Union[DataFrame, OutlierTable, str],
+    iqrs: Union[float, Iterable[float]] = 1.5,
+    up_or_down: str = "up",
+    aggregate: bool = True,
+    save_outlier_table: bool = False,
+    save_frac_table: bool = False,
+    output_prefix: str = "outliers",
+    ind_sep: str = "-",
+    samples: Optional[List[str]] = None,
+    dtype: str = "float64",
+) -> Union[OutlierTable, List[OutlierTable]]:
+    """Calls outliers using stored row medians and IQRs, for instance at another IQR \
+    threshold or in the other direction, or for new samples scored against the bounds of a \
+    reference cohort. Values are only compared to the outlier bounds; no medians or IQRs are \
+    recalculated, so the cost depends on the number of samples being called rather than the \
+    size of the cohort the bounds came from.
+
+    Args:
+        df: Input DataFrame with samples as columns and sites/genes as rows. These can be the \
+        values the row statistics were calculated from or new samples. Can also be a path to a \
+        .csv or .tsv file of values.
+        row_stats: Row medians and IQRs, as saved with save_row_stats, or an OutlierTable \
+        made by make_outliers_table. Can also be a path to a saved row statistics file. Rows \
+        of df without stored statistics have no outliers.
+        iqrs: The number of IQRs above or below the median to consider a value as an outlier. \
+        Can be a list of thresholds.
+        up_or_down: Whether to call up or down outliers. Options "up", "down" or "both".
+        aggregate: Whether to sum outliers across a grouping (e.g. gene-level) rather than \
+        individual sites.
+        save_outlier_table: Whether to write a file with the outlier count table.
+        save_frac_table: Whether to write a file with the outlier fraction table.
+        output_prefix: If files are written, a prefix for the files.
+        ind_sep: The separator used in sites, for instance, to separate a gene and site.
+        samples: Columns of df to call outliers for, e.g. only the new samples. Default is all \
+        columns.
+        dtype: Float type to call outliers in, "float64" or "float32", as in \
+        make_outliers_table.
+
+    Returns: outliers
+        Returns an OutlierTable object, or a list of OutlierTables if up_or_down is "both" or
+        several iqrs are given, the same as make_outliers_table.
+
+    """
+    to_call = _get_directions(up_or_down)
+    iqrs_list = _get_iqrs(iqrs)
+    values_dtype = _get_dtype(dtype)
+    if isinstance(df, str):
+        df = read_in_values(df, dtype=dtype)
+    if samples is not None:
+        missing_samples = [sample for sample in samples if sample not in df.columns]
+        if missing_samples:
+            raise ValueError("Samples not in values: %s" % ", ".join(missing_samples))
+        df = df[samples]
+    if isinstance(row_stats, str):
+        row_stats = read_in_row_stats(row_stats)
+    elif isinstance(row_stats, OutlierTable):
+        if row_stats.row_stats is None:
+            raise ValueError("OutlierTable does not have row statistics")
+        row_stats = row_stats.row_stats
+
+    missing = ~df.index.isin(row_stats.index)
+    if missing.any():
+        logging.warning(
+            "%s rows have no stored row statistics and will not have outliers" % missing.sum()
         )
-        logging.info("Saving outlier table to %s" % out_path)
-        df.to_csv(out_path, sep="\t")
+    row_stats = row_stats.reindex(df.index)
 
-    return outliers
+    logging.info("Calling outliers for %s samples from stored row statistics" % len(df.columns))
+    outliers_tables = _make_outliers_tables(
+        df, iqrs_list, to_call, aggregate, ind_sep, row_stats=row_stats, dtype=values_dtype
+    )
+    return _finish_outliers_tables(
+        outliers_tables,
+        save_outlier_table,
+        save_frac_table,
+        False,
+        output_prefix,
+        len(iqrs_list) > 1,
+    )
 
 
 def compare_groups_outliers(
-    outliers: OutlierTable,
+    outliers: Union[OutlierTable, Iterable[OutlierTable]],
     annotations: DataFrame,
     frac_filter: Optional[float] = 0.3,
     save_qvalues: bool = False,
     output_prefix: str = "outliers",
     save_comparison_summaries: bool = False,
-) -> qValues:
+    backend: Optional[str] = None,
+    n_jobs: int = 1,
+    test: str = "fisher",
+    n_permutations: int = 1000,
+    seed: Optional[int] = None,
+) -> Union[qValues, List[qValues]]:
     """Takes an OutlierTable object and a sample annotation DataFrame and performs comparisons for
-    any column in annotations with exactly 2 groups. For each group identified in the annotations
+    any column in annotations with at least 2 groups. For each group identified in the annotations
     DataFrame, this function will calculate the q-values of enrichment of outliers for each row in
-    each group.
+    each group. Columns with more than 2 groups compare each group to the rest of the column, as
+    if the column had been expanded with binarize_annotations.
 
     Args:
         outliers: An OutlierTable, with a DataFrame of outlier and non-outlier counts, \
-        as well as parameters for how outliers were calculated.
+        as well as parameters for how outliers were calculated. Can also be a list of \
+        OutlierTables, such as the up and down tables or the tables for several IQR \
+        thresholds from make_outliers_table, in which case comparisons are run for each \
+        table. If the tables have different IQR thresholds, written files have \
+        ".iqrs<threshold>" added to the output prefix.
         annotations: A DataFrame with samples as rows and annotations as columns. Each \
-        column must contain exactly 2 different categories, not counting missing values. Columns \
-        without 2 options will be ignored.
+        column must contain at least 2 different categories, not counting missing values. \
+        Columns with 2 categories are compared as they are. For columns with more, each \
+        category is compared to the other annotated samples, with results named like the \
+        "<column>_<category>" columns of binarize_annotations. Columns with less than 2 \
+        options will be ignored.
         frac_filter: The fraction of samples in the group of interest that must \
         have an outlier value to be considered in the comparison. Float between 0 and 1 or None.
         save_qvalues: Whether to write a file with a table of qvalues.
         output_prefix: If files are written, a prefix for the files.
         save_comparison_summaries: Whether to write a file for each annotation column with the \
         counts in the fisher table, pvalues and q values per row.
+        backend: Implementation of the fisher tests. Options "numpy" (vectorized over rows), \
+        "numba" or "auto" (numba when it is installed). Both agree with scipy's fisher_exact \
+        to about 1e-10 (relative). Default uses the BLACKSHEEP_BACKEND environment variable, or "auto" if it \
+        is not set.
+        n_jobs: Number of processes to run comparisons in. Processes read the count table \
+        from shared memory and each runs blocks of annotation columns; results are the same \
+        and in the same order as with one process. -1 uses all cores.
+        test: "fisher" for fisher exact tests of the outlier and not outlier counts, or \
+        "permutation" for permutation tests of the sample labels, which keep the sites of \
+        each sample together instead of treating them as independent. Permutation p-values \
+        and q-values are written to the same columns as fisher ones.
+        n_permutations: Maximum number of permutations for each row in permutation tests. \
+        Rows stop early once 10 permutations are at least as extreme as the observed \
+        labels, so the smallest possible p-value is 1 / (n_permutations + 1).
+        seed: Seed for the permutations. Each comparison is seeded from it and its label, \
+        so results do not depend on n_jobs or the other annotation columns.
 
     Returns: qvals
         A qValues object, which includes a DataFrame of q-values for each comparison, \
-        as well as some metadata about how the comparisons were performed.
+        as well as some metadata about how the comparisons were performed. If a list of \
+        OutlierTables was given, a list with a qValues object for each table.
 
 
     """
 
-    df = outliers.df
+    if not isinstance(outliers, OutlierTable):
+        outliers = list(outliers)
+        sweep = len(set(table.iqrs for table in outliers)) > 1
+        return [
+            compare_groups_outliers(
+                table,
+                annotations,
+                frac_filter,
+                save_qvalues,
+                _get_table_prefix(output_prefix, table, sweep),
+                save_comparison_summaries,
+                backend,
+                n_jobs,
+                test,
+                n_permutations,
+                seed,
+            )
+            for table in outliers
+        ]
+
+    backend = _get_backend(backend)
+    n_jobs = _get_n_jobs(n_jobs)
+    if test not in comparison_tests:
+        raise ValueError("test must be one of %s" % ", ".join(comparison_tests))
+    permutations = None
+    if test == "permutation":
+        if n_permutations < 1:
+            raise ValueError("n_permutations must be at least 1")
+        # Seeds of each comparison are derived from this in every process
+        permutations = (n_permutations, np.random.SeedSequence(seed).entropy)
+
     samples = outliers.samples
     up_or_down = outliers.up_or_down
-    results_df = pd.DataFrame(index=df.index)
+    comparisons = []
+    comps = []
     for comp in annotations.columns:
-        logging.info("Testing for enrichment in %s comparison" % comp)
-
-        group0_label, group0, group1_label, group1 = get_sample_lists(annotations, comp)
+        categories, groups = get_category_lists(annotations, comp)
         # Checking everything is in place
-        if group0 is None:
+        if len(categories) < 2:
+            comps.append(comp)
             logging.error(
-                "There are not exactly 2 groups of samples, skipping %s" % comp
+                "There are not at least 2 groups of samples, skipping %s" % comp
             )
             continue
-        not_there = [samp for samp in group0 if samp not in samples] + [
-            samp for samp in group1 if samp not in samples
-        ]
+        not_there = [samp for group in groups for samp in group if samp not in samples]
         if not_there:
             logging.warning(
                 "These samples were not found in outliers table: "
                 "%s, continuing without them. " % ", ".join(not_there)
             )
-        group0 = [samp for samp in group0 if samp in samples]
-        group1 = [samp for samp in group1 if samp in samples]
-        if len(group0) < 2:
-            logging.error(
-                "Group %s does not have at least two samples, "
-                "skipping comparison %s. " % (group0_label, comp)
-            )
-            continue
-        if len(group1) < 2:
-            logging.error(
-                "Group %s does not have at least two samples, "
-                "skipping comparison%s. " % (group1_label, comp)
-            )
-            continue
-
-        # doing tests
-        label0 = fdr_col_label % (comp, group0_label)
-        results_df, fisher_info0 = _compare_groups(
-            results_df, df, group0, group1, frac_filter, label0
-        )
+        groups = [[samp for samp in group if samp in samples] for group in groups]
+        if len(categories) == 2:
+            comps.append(comp)
+            labels = categories
+            small = [label for label, group in zip(labels, groups) if len(group) < 2]
+            if small:
+                logging.error(
+                    "Group %s does not have at least two samples, "
+                    "skipping comparison %s. " % (small[0], comp)
+                )
+                continue
+        else:
+            labels = [str(category).replace("_", "-") for category in categories]
+            comps.extend(binarized_col_name % (comp, label) for label in labels)
+            n_annotated = sum(len(group) for group in groups)
+            for position, group in enumerate(groups):
+                if len(group) < 2 or n_annotated - len(group) < 2:
+                    logging.error(
+                        "Group %s or the rest of %s does not have at least two samples, "
+                        "skipping comparison %s. "
+                        % (labels[position], comp, binarized_col_name % (comp, labels[position]))
+                    )
+                    labels[position] = None
+            if all(label is None for label in labels):
+                continue
+        comparisons.append((comp, labels, groups))
 
-        label1 = fdr_col_label % (comp, group1_label)
-        results_df, fisher_info1 = _compare_groups(
-            results_df, df, group1, group0, frac_filter, label1
+    if n_jobs > 1 and len(comparisons) > 1:
+        results = _parallel_comparisons(
+            outliers, comparisons, frac_filter, n_jobs, backend, permutations
         )
+    else:
+        results = _run_comparisons(outliers, comparisons, frac_filter, backend, permutations)
+    pairs = [pair for comparison in comparisons for pair in _comparison_pairs(comparison)]
+    labels = [
+        fdr_col_label % (name, label)
+        for name, _, group0_label, group1_label in pairs
+        for label in (group0_label, group1_label)
+    ]
+    collector = _QValueCollector(outliers.index, labels)
+    for col, _ in results:
+        if col is not None:
+            collector.add(col)
+    results_df = collector.to_frame()
 
-        if save_comparison_summaries:
+    if save_comparison_summaries:
+        for position, (comp, _, group0_label, group1_label) in enumerate(pairs):
+            (_, fisher_info0), (_, fisher_info1) = results[2 * position:2 * position + 2]
+            label0 = fdr_col_label % (comp, group0_label)
+            label1 = fdr_col_label % (comp, group1_label)
             fisher_info0.columns = [
                 "%s_%s_%s" % (outlier_count_lab, comp, group0_label),
                 "%s_%s_%s" % (outlier_count_lab, comp, group1_label),
@@ -178,21 +981,89 @@ def compare_groups_outliers(
                     ind_comparison_file_name % (output_prefix, up_or_down, comp),
                     sep="\t",
                 )
-    results_df = results_df.dropna(how="all", axis=0)
     if save_qvalues:
         qval_path = os.path.abspath(qvalues_file_name % (output_prefix, up_or_down))
         logging.info("Saving qvalues to %s" % qval_path)
         results_df.to_csv(qval_path, sep="\t")
-    qvals = qValues(results_df, annotations.columns, frac_filter)
+    qvals = qValues(results_df, pd.Index(comps), frac_filter)
     return qvals
 
 
-def deva(
+def jackknife_qvalues(
     df: DataFrame,
     annotations: DataFrame,
     iqrs: float = 1.5,
     up_or_down: str = "up",
     aggregate: bool = True,
+    frac_filter: Optional[float] = 0.3,
+    ind_sep: str = "-",
+    backend: Optional[str] = None,
+) -> DataFrame:
+    """Checks how stable each q-value is by leaving out one sample at a time. Row medians and
+    IQRs without each sample are read from ordered rows (see OrderedOutlierTable) instead of
+    being calculated again, and outliers are called and compared for every left out sample.
+
+    Args:
+        df: Input DataFrame with samples as columns and sites/genes as rows.
+        annotations: A DataFrame with samples as rows and annotations as columns, see \
+        compare_groups_outliers.
+        iqrs: The number of IQRs above or below the median to consider a value as an outlier.
+        up_or_down: Whether to call up or down outliers. Options "up" or "down".
+        aggregate: Whether to sum outliers per gene.
+        frac_filter: The fraction of samples in the group of interest that must have an \
+        outlier value to be considered in the comparison. Float between 0 and 1 or None.
+        ind_sep: The separator used in sites to separate a gene and site.
+        backend: Implementation of the fisher tests, see compare_groups_outliers.
+
+    Returns: DataFrame with the q-values of every sample, and for each comparison the largest \
+    q-value with one sample left out (<comparison>_jackknifeMax) and the jackknife standard \
+    error (<comparison>_jackknifeSE), for rows tested with every sample. Rows that are not \
+    tested without a sample count as a q-value of 1 for that sample.
+
+    """
+    if up_or_down not in directions:
+        raise ValueError("up_or_down must be either 'up' or 'down'")
+    if np.iterable(iqrs):
+        raise ValueError("jackknife_qvalues takes a single iqrs threshold")
+    outliers = OrderedOutlierTable(df, iqrs, up_or_down, aggregate, ind_sep)
+    qvals = compare_groups_outliers(outliers, annotations, frac_filter, backend=backend).df
+
+    left_out = []
+    for sample in outliers.samples:
+        logging.info("Leaving out %s" % sample)
+        left_out.append(
+            compare_groups_outliers(
+                outliers.without_sample(sample),
+                annotations.drop(sample, errors="ignore"),
+                frac_filter,
+                backend=backend,
+            )
+            .df.reindex(index=qvals.index, columns=qvals.columns)
+            .to_numpy()
+        )
+    left_out = np.nan_to_num(np.stack(left_out), nan=1.0)
+    n_samples = len(left_out)
+    jackknife_se = np.sqrt(
+        (n_samples - 1) / n_samples * ((left_out - left_out.mean(axis=0)) ** 2).sum(axis=0)
+    )
+
+    results = {}
+    for position, col in enumerate(qvals.columns):
+        results[col] = qvals[col]
+        tested = qvals[col].notna().to_numpy()
+        results[jackknife_max_col % col] = np.where(
+            tested, left_out[:, :, position].max(axis=0), np.nan
+        )
+        results[jackknife_se_col % col] = np.where(tested, jackknife_se[:, position], np.nan)
+    return DataFrame(results, index=qvals.index)
+
+
+def deva(
+    df: Union[DataFrame, np.ndarray, "pyarrow.Table"],
+    annotations: DataFrame,
+    iqrs: Union[float, Iterable[float]] = 1.5,
+    up_or_down: str = "up",
+    aggregate: bool = True,
     save_outlier_table: bool = False,
     save_frac_table: bool = False,
     frac_filter: Optional[float] = 0.3,
@@ -200,7 +1071,15 @@ def deva(
     output_prefix: str = "outliers",
     ind_sep: str = "-",
     save_comparison_summaries: bool = False,
-) -> Tuple[OutlierTable, qValues]:
+    n_jobs: int = 1,
+    dtype: str = "float64",
+    approximate: bool = False,
+    sketch_size: int = 1024,
+    backend: Optional[str] = None,
+    row_labels: Optional[Union[Iterable, str]] = None,
+    sample_labels: Optional[Iterable] = None,
+    incremental: bool = False,
+) -> Tuple[Union[OutlierTable, List[OutlierTable]], Union[qValues, List[qValues]]]:
     """
     Takes a DataFrame of values and returns OutlierTable and qValues objects. This command runs
     the whole outliers pipeline. The DataFrame in the OutlierTable object can be used to run more
@@ -208,14 +1087,17 @@ def deva(
     significant gene lists.
 
     Args:
-        df: Input DataFrame with samples as columns and sites/genes as rows.
+        df: Input DataFrame with samples as columns and sites/genes as rows. Can also be a 2D \
+        numpy array with row_labels and sample_labels, or a pyarrow Table, see \
+        make_outliers_table.
         annotations: A DataFrame with samples as rows and annotations as columns. Each \
-        column must contain exactly 2 different values, not counting missing \
-        values. Other columns will be ignored.
+        column must contain at least 2 different values, not counting missing \
+        values. Columns with more than 2 compare each value to the rest, see \
+        compare_groups_outliers. Other columns will be ignored.
         iqrs: The number of interquartile ranges (IQRs) above or below the median to consider a \
-        value as an outlier.
+        value as an outlier. Can be a list of thresholds.
         up_or_down: Whether to call up or down outliers. Up is above the median; down \
-        is below the median. Options "up" or "down".
+        is below the median. Options "up", "down" or "both".
         aggregate: Whether to sum outliers across a grouping (e.g. gene-level) than individual \
         sites. For instance if columns indicate phosphosites on proteins, with the format \
         "RAG2-S365", output will show counts of outliers per protein (e.g. RAG2) rather than on \
@@ -231,9 +1113,28 @@ def deva(
         has no effect.
         save_comparison_summaries: Whether to write a table for each comparison with the \
         counts in the fisher table, pvalues and qvalues per row.
+        n_jobs: Number of processes used to calculate row medians and IQRs and to run \
+        comparisons. -1 uses all cores.
+        dtype: Float type to call outliers in, "float64" or "float32". See \
+        make_outliers_table for how float32 can change calls and q-values.
+        approximate: Whether to estimate row medians and IQRs from a quantile sketch of each \
+        row. See make_outliers_table.
+        sketch_size: Number of values per row in each level of the sketch when approximate \
+        is used.
+        backend: Implementation of the outlier calls and fisher tests. Options "numpy", \
+        "numba" or "auto" (numba when it is installed). Default uses the BLACKSHEEP_BACKEND \
+        environment variable, or "auto" if it is not set.
+        row_labels: If df is a 2D array, the label of each row. If df is a pyarrow Table, the \
+        name of the column with row labels, or the labels themselves.
+        sample_labels: If df is a 2D array, the label of each column. If df is a pyarrow \
+        Table, which columns are samples; default is every column except the row labels.
+        incremental: Whether to only recalculate rows that changed since the last run with \
+        the same output_prefix, see make_outliers_table. Needs save_outlier_table. q-values \
+        are always recalculated from the merged counts.
 
     Returns: outliers, qvals
-        Returns an OutlierTable object and qValues object.
+        Returns an OutlierTable object and qValues object. If up_or_down is "both" or several \
+        iqrs are given, returns a list of OutlierTables and a matching list of qValues.
 
     """
 
@@ -247,6 +1148,14 @@ def deva(
         save_frac_table,
         output_prefix,
         ind_sep,
+        n_jobs=n_jobs,
+        dtype=dtype,
+        approximate=approximate,
+        sketch_size=sketch_size,
+        backend=backend,
+        row_labels=row_labels,
+        sample_labels=sample_labels,
+        incremental=incremental,
     )
 
     logging.info("Performing group comparisons")
@@ -257,6 +1166,8 @@ def deva(
         save_qvalues,
         output_prefix,
         save_comparison_summaries,
+        backend,
+        n_jobs,
     )
 
     return outliers, qvals
@@ -2,8 +2,9 @@ import os.path
 import pandas as pd
 import numpy as np
 from pandas import DataFrame
-from typing import Iterable
+from typing import Iterable, Iterator, Optional, Union
 from blacksheep.classes import OutlierTable
+from blacksheep._outlierTable import _group_index
 from blacksheep._constants import *
 
 
@@ -57,22 +58,116 @@ def _check_suffix(path: str) -> str:
     raise ValueError("File must be .csv or .tsv")
 
 
-def read_in_values(path: str) -> DataFrame:
+def read_in_values(
+        path: str, chunksize: Optional[int] = None, dtype: Optional[str] = None
+) -> Union[DataFrame, Iterator[DataFrame]]:
     """Figures out sep and parsing file into dataframe.
 
     Args:
         path: File path
+        chunksize: If given, returns an iterator of DataFrames with this many rows each \
+        instead of reading the whole file.
+        dtype: If given, the type to parse every value column as, e.g. "float32". The index \
+        column is parsed as usual.
 
     Returns: df
         DataFrame from table in file
 
     """
     sep = _check_suffix(path)
-    return pd.read_csv(_is_valid_file(path), sep=sep, index_col=0)
+    path = _is_valid_file(path)
+    if dtype is not None:
+        columns = pd.read_csv(path, sep=sep, index_col=0, nrows=0).columns
+        dtype = {col: dtype for col in columns}
+    return pd.read_csv(path, sep=sep, index_col=0, chunksize=chunksize, dtype=dtype)
+
+
+def _is_arrow_table(data) -> bool:
+    """Checks for a pyarrow Table without importing pyarrow."""
+    return type(data).__module__.startswith("pyarrow") and hasattr(data, "column_names")
+
+
+def _as_values_frame(
+        data,
+        row_labels: Optional[Union[Iterable, str]] = None,
+        sample_labels: Optional[Iterable] = None,
+        dtype: Optional[str] = None,
+) -> DataFrame:
+    """Wraps values given as a DataFrame, a 2D array or a pyarrow Table in a DataFrame, without
+    copying the values where possible.
+
+    Args:
+        data: DataFrame, 2D numpy array (including memory-mapped arrays) or pyarrow Table, \
+        with samples as columns and sites/genes as rows.
+        row_labels: Labels of the rows of an array. For a pyarrow Table, either the name of \
+        the column with row labels or the labels themselves.
+        sample_labels: Labels of the columns of an array. For a pyarrow Table, which columns \
+        to use as samples; default is every column except the row labels.
+        dtype: Float type the values will be used as. Arrays of this type are not copied.
+
+    Returns: df
+        DataFrame with row labels as the index and samples as columns. For arrays, it shares \
+        memory with data. pyarrow Tables are copied once, column by column, into a matrix.
+
+    """
+    if isinstance(data, DataFrame):
+        if (row_labels is not None) or (sample_labels is not None):
+            raise ValueError("row_labels and sample_labels are only used with arrays and tables")
+        return data
+
+    if _is_arrow_table(data):
+        label_column = row_labels if isinstance(row_labels, str) else None
+        if label_column is not None:
+            row_labels = data.column(label_column).to_pylist()
+        if sample_labels is None:
+            sample_labels = [col for col in data.column_names if col != label_column]
+        sample_labels = list(sample_labels)
+        values = np.empty(
+            (data.num_rows, len(sample_labels)), dtype=dtype or np.float64, order="F"
+        )
+        for position, sample in enumerate(sample_labels):
+            values[:, position] = data.column(sample).to_numpy()
+        data = values
+
+    data = np.asarray(data, dtype=dtype)
+    if data.ndim != 2:
+        raise ValueError("values must be a 2D array")
+    if (row_labels is None) or (sample_labels is None):
+        raise ValueError("row_labels and sample_labels are needed for array values")
+    row_labels, sample_labels = pd.Index(row_labels), pd.Index(sample_labels)
+    if data.shape != (len(row_labels), len(sample_labels)):
+        raise ValueError(
+            "values have shape %s but there are %s row labels and %s sample labels"
+            % (data.shape, len(row_labels), len(sample_labels))
+        )
+    return DataFrame(data, index=row_labels, columns=sample_labels, copy=False)
+
+
+def read_in_row_stats(path: str) -> DataFrame:
+    """Parses a row statistics file written with save_row_stats.
+
+    Args:
+        path: File path
+
+    Returns: row_stats
+        DataFrame with the median and IQR of each row
+
+    """
+    sep = _check_suffix(path)
+    # Statistics are read back exactly as written, so calls match the run that wrote them
+    row_stats = pd.read_csv(
+        _is_valid_file(path), sep=sep, index_col=0, float_precision="round_trip"
+    )
+    missing = [col for col in (row_median_name, row_iqr_name) if col not in row_stats.columns]
+    if missing:
+        raise ValueError("%s is missing columns: %s" % (path, ", ".join(missing)))
+    return row_stats
 
 
 def read_in_outliers(path: str, updown: str, iqrs: float) -> OutlierTable:
-    """Parses a file into an OutlierTable object.
+    """Parses a file into an OutlierTable object. Tables where no sample has more than one
+    value in a row are read as site-level (not aggregated) tables, so comparisons can use the
+    p-value grids for site-level tables.
 
     Args:
         path: File path
@@ -87,7 +182,9 @@ def read_in_outliers(path: str, updown: str, iqrs: float) -> OutlierTable:
     sep = _check_suffix(path)
     df = pd.read_csv(_is_valid_file(path), sep=sep, index_col=0)
     samples = sorted(list(set([ind.rsplit(col_seps, 1)[0] for ind in df.columns])))
-    return OutlierTable(df, updown, iqrs, samples, None)
+    outliers = OutlierTable(df, updown, iqrs, samples, None)
+    outliers.aggregated = bool((outliers.valid_counts > 1).any())
+    return outliers
 
 
 def binarize_annotations(df: DataFrame) -> DataFrame:
@@ -137,5 +234,6 @@ def subset_by_genes(
         outliers: DataFrame, ind_list: Iterable[str], ind_sep: str = None,
         ) -> DataFrame:
     if ind_sep:
-        return outliers.loc[[i for i in outliers.index if i.split(ind_sep, 1)[0] in ind_list], :]
+        group_codes, groups = _group_index(outliers.index, ind_sep)
+        return outliers.loc[groups.isin(list(ind_list))[group_codes], :]
     return outliers.loc[ind_list, :]
\ No newline at end of file
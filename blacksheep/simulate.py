@@ -17,6 +17,7 @@ import numpy as np
 from scipy.stats import ttest_1samp
 from scipy.stats import percentileofscore
 from scipy.stats import gaussian_kde
+from blacksheep._outlierTable import _group_index
 
 # Argparser, when testing on its own
 def _make_parser():
@@ -73,38 +74,37 @@ def _make_parser():
 
     return parser
 
-def get_full_gene_list(ind_sep, infile):
-	# Gets a list of all molecules in the file
-	f = open(infile, 'r')
-	genes = set([])
-	line = f.readline() # Header line
-	line = f.readline()
-	while line:
-		genes.add(line.split()[0].split(ind_sep)[0])
-		line = f.readline()
-	return genes
-
-
-def get_values(gene, ind_sep, infile):
-	# Digs around in the input file for the specified gene
-	f = open(infile,'r')
+def parse_gene_lines(lines, total):
+	# Pulls the values out of the lines of one gene
 	values = {} # only non-missing values
 	missings = {} # missing values
 	all_values = {} # all values, including missing and present
-	line = f.readline()
-	total = len(line.split())-1
-	while line:
-		if line.split(ind_sep)[0] == gene and len(line.split()) > 1:
+	for line in lines:
+		if len(line.split()) > 1:
 			temp_vals = [float(num) for num in line.split()[1:]]
 			if len(temp_vals) > 1:
-				values[line.split()[0]] = [float(num) for num in line.split()[1:]]
+				values[line.split()[0]] = temp_vals
 				missings[line.split()[0]] = 1-(len(values[line.split()[0]])/float(total))
 				all_values[line.split()[0]] = line.rstrip('\n').split('\t')[1:]
-		line = f.readline()
-		
+
 	return values, missings, all_values
 
 
+def get_lines_by_gene(ind_sep, infile):
+	# Reads the file once and groups its lines by molecule with the factorized group index
+	f = open(infile, 'r')
+	total = len(f.readline().split())-1
+	lines = [line for line in f if line.split()]
+	f.close()
+	group_codes, groups = _group_index([line.split()[0] for line in lines], ind_sep)
+	order = np.argsort(group_codes, kind="stable")
+	bounds = np.cumsum(np.bincount(group_codes, minlength=len(groups)))[:-1]
+	lines_by_gene = {
+		gene: [lines[i] for i in rows] for gene, rows in zip(groups, np.split(order, bounds))
+	}
+	return lines_by_gene, total
+
+
 def outlier_thresholds(values, thresh):
 	# Fixes the value that is (threshold) IQR above the median for each phospho
 	o_thresh = {}
@@ -195,12 +195,13 @@ def run_simulations(infile, ind_sep, thresh, reps, outfile, genes, pval):
 	w.write(f.readline())
 	f.close()
 	
+	lines_by_gene, total = get_lines_by_gene(ind_sep, infile)
 	if len(genes) == 0:
-		genes = get_full_gene_list(ind_sep, infile)
+		genes = list(lines_by_gene.keys())
 	
-	for gene in genes: # Can make this much more efficient
+	for gene in genes:
 		# Get values for your gene from the input file
-		values, missings, all_values = get_values(gene, ind_sep, infile)
+		values, missings, all_values = parse_gene_lines(lines_by_gene.get(gene, []), total)
 		# Figure out the outlier threshold for each phosphosite
 		o_thresh = outlier_thresholds(values, thresh)
 		# Do the actual simulation
@@ -26,6 +26,7 @@ setuptools.setup(
         "seaborn >= 0.11.1",
         "statsmodels >= 0.12.2"
     ],
+    extras_require={"jit": ["numba >= 0.53"]},
     packages=setuptools.find_packages(
         exclude=["*.tests", "*.tests.*", "tests.*", "tests"]
     ),
@@ -1,4 +1,9 @@
+import pytest
+import numpy as np
+import pandas as pd
 from blacksheep.cli import _main
+from blacksheep import compare_groups_outliers, make_outliers_table
+from blacksheep._fisher import _fisher_grids as fisher_grids
 
 
 def test_cli_outliers_table():
@@ -126,3 +131,168 @@ def test_cli_pipeline_with_figures():
     _main(args)
 
 
+
+
+def test_cli_pipeline_both(tmp_path):
+    args = [
+        "deva",
+        "tests/pidgin_values.csv",
+        "tests/pidgin_annotations.csv",
+        "--up_or_down",
+        "both",
+        "--output_prefix",
+        str(tmp_path / "pipeline_both_test"),
+        "--write_outlier_table",
+        "--frac_filter",
+        "0.10",
+        "--fdr",
+        "0.5",
+        "--write_gene_list",
+    ]
+
+    _main(args)
+    assert (tmp_path / "pipeline_both_test.up.count_table.tsv").exists()
+    assert (tmp_path / "pipeline_both_test.down.qvalues.tsv").exists()
+
+
+def test_cli_outliers_table_streaming(tmp_path):
+    args = [
+        "outliers_table",
+        "tests/pidgin_values.csv",
+        "--output_prefix",
+        str(tmp_path / "outliers_table_streaming_test"),
+        "--chunksize",
+        "4",
+        "--write_frac_table",
+    ]
+
+    _main(args)
+    streamed = pd.read_csv(
+        tmp_path / "outliers_table_streaming_test.up.count_table.tsv", sep="\t", index_col=0
+    )
+    expected = make_outliers_table(pd.read_csv("tests/pidgin_values.csv", index_col=0)).df
+    assert streamed.astype(float).equals(expected.astype(float))
+
+
+def test_cli_outliers_table_iqrs_sweep(tmp_path):
+    args = [
+        "outliers_table",
+        "tests/pidgin_values.csv",
+        "--iqrs",
+        "1",
+        "2",
+        "--output_prefix",
+        str(tmp_path / "outliers_table_sweep_test"),
+    ]
+
+    _main(args)
+    assert (tmp_path / "outliers_table_sweep_test.iqrs1.0.up.count_table.tsv").exists()
+    assert (tmp_path / "outliers_table_sweep_test.iqrs2.0.up.count_table.tsv").exists()
+
+
+def test_cli_outliers_table_reference(tmp_path):
+    values = pd.read_csv("tests/pidgin_values.csv", index_col=0)
+    reference, new = values.iloc[:, :-3], values.iloc[:, -3:]
+    reference.to_csv(tmp_path / "reference_values.csv")
+    new.to_csv(tmp_path / "new_values.csv")
+    _main(
+        [
+            "outliers_table",
+            str(tmp_path / "reference_values.csv"),
+            "--output_prefix",
+            str(tmp_path / "reference_test"),
+            "--write_row_stats",
+        ]
+    )
+    _main(
+        [
+            "outliers_table",
+            str(tmp_path / "new_values.csv"),
+            "--output_prefix",
+            str(tmp_path / "reference_new_test"),
+            "--reference_row_stats",
+            str(tmp_path / "reference_test.row_stats.tsv"),
+        ]
+    )
+    scored = pd.read_csv(
+        tmp_path / "reference_new_test.up.count_table.tsv", sep="\t", index_col=0
+    )
+    stats = make_outliers_table(reference).row_stats
+    up = new.gt(stats["row_medPlus"], axis=0)
+    expected = up.groupby(new.index.str.split("-", n=1).str[0]).sum()
+    for sample in new.columns:
+        assert scored["%s_outliers" % sample].sort_index().tolist() == (
+            expected[sample].sort_index().tolist()
+        )
+
+
+@pytest.mark.parametrize(
+    "flags",
+    [
+        ["--chunksize", "5"],
+        ["--n_jobs", "2"],
+        ["--write_row_stats"],
+        ["--approximate"],
+        ["--incremental"],
+    ],
+)
+def test_cli_outliers_table_reference_unused_flags(flags, capsys, tmp_path):
+    with pytest.raises(SystemExit):
+        _main(
+            [
+                "outliers_table",
+                "tests/pidgin_values.csv",
+                "--output_prefix",
+                str(tmp_path / "reference_flags_test"),
+                "--reference_row_stats",
+                "tests/pidgin_values.csv",
+            ]
+            + flags
+        )
+    assert "%s cannot be used with --reference_row_stats" % flags[0] in capsys.readouterr().err
+
+
+def test_cli_compare_groups_sites(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = ["s%d" % i for i in range(12)]
+    values = pd.DataFrame(
+        rng.normal(size=(2000, 12)),
+        index=["g%d-%d" % (i // 4, i) for i in range(2000)],
+        columns=samples,
+    )
+    values.iloc[:, :6] += rng.normal(size=(2000, 1)) > 1
+    annotations = pd.DataFrame({"comp": ["a"] * 6 + ["b"] * 6}, index=samples)
+    values.to_csv(tmp_path / "values.csv")
+    annotations.to_csv(tmp_path / "annotations.csv")
+    _main(
+        [
+            "outliers_table",
+            str(tmp_path / "values.csv"),
+            "--output_prefix",
+            str(tmp_path / "sites"),
+            "--do_not_aggregate",
+        ]
+    )
+    fisher_grids.clear()
+    _main(
+        [
+            "compare_groups",
+            str(tmp_path / "sites.up.count_table.tsv"),
+            str(tmp_path / "annotations.csv"),
+            "--output_prefix",
+            str(tmp_path / "compare_sites"),
+            "--up_or_down",
+            "up",
+            "--frac_filter",
+            "0",
+        ]
+    )
+    # Site-level tables read from files use the p-value grids
+    assert (6, 6) in fisher_grids
+    qvalues = pd.read_csv(tmp_path / "compare_sites.up.qvalues.tsv", sep="\t", index_col=0)
+    expected = compare_groups_outliers(
+        make_outliers_table(values, aggregate=False), annotations, frac_filter=0
+    ).df
+    assert np.allclose(
+        qvalues.loc[expected.index, expected.columns], expected, rtol=1e-9, equal_nan=True
+    )
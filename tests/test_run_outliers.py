@@ -1,5 +1,13 @@
 import pickle
+import tracemalloc
+import pytest
+import numpy as np
+import pandas as pd
 import blacksheep as bsh
+from blacksheep._outlierTable import _convert_to_outliers, _row_quantiles
+from blacksheep._fisher import _fisher_exact, _fisher_lookup
+from blacksheep._permutation import _permutation_pvalues
+from blacksheep._sketch import _RowSketch, _uncertain_calls
 
 
 def test_outliers_table():
@@ -88,3 +96,491 @@ def test_normalizer():
         df, annotations, outliers, fractable, qvalues = pickle.load(fh)
     bsh.normalize(df)
 
+
+
+def test_outlier_masks():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    outlier_mask, valid_mask = _convert_to_outliers(df, df.columns, 1.5, "up")
+    assert outlier_mask.dtype == bool and valid_mask.dtype == bool
+    assert (valid_mask == df.notnull().values).all()
+
+    bound = df.median(axis=1) + 1.5 * (df.quantile(0.75, axis=1) - df.quantile(0.25, axis=1))
+    assert (outlier_mask == df.gt(bound, axis=0).values).all()
+
+
+def test_outliers_table_both():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    up, down = bsh.make_outliers_table(df, up_or_down="both")
+    assert (up.up_or_down, down.up_or_down) == ("up", "down")
+    assert up.df.equals(bsh.make_outliers_table(df, up_or_down="up").df)
+    assert down.df.equals(bsh.make_outliers_table(df, up_or_down="down").df)
+
+    qvals = bsh.compare_groups_outliers([up, down], annotations)
+    assert len(qvals) == 2
+    assert qvals[0].df.equals(bsh.compare_groups_outliers(up, annotations).df)
+
+
+def test_outliers_table_n_jobs():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    serial = bsh.make_outliers_table(df, up_or_down="both")
+    parallel = bsh.make_outliers_table(df, up_or_down="both", n_jobs=2)
+    for serial_table, parallel_table in zip(serial, parallel):
+        assert serial_table.df.equals(parallel_table.df)
+
+
+def test_outliers_table_counts():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    test_outliers = bsh.make_outliers_table(df)
+    assert test_outliers.outlier_counts.dtype.kind == "i"
+    assert test_outliers.outlier_counts.shape == (len(test_outliers.index), len(df.columns))
+
+    from_df = bsh.OutlierTable(outliers, "up", 1.5, df.columns, None)
+    from_df = from_df.frac_table.reindex(test_outliers.index)
+    assert test_outliers.frac_table.equals(from_df)
+
+
+def test_outliers_table_subset_by_genes():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    sites = bsh.make_outliers_table(df, aggregate=False)
+    assert list(sites.groups[sites.group_codes]) == [i.split("-")[0] for i in df.index]
+
+    subset = sites.subset_by_genes(["geneC", "geneH"], "-")
+    expected = bsh.parsers.subset_by_genes(sites.df, ["geneC", "geneH"], "-")
+    assert subset.df.equals(expected)
+
+
+def test_outliers_table_iqrs_sweep():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    sweep = bsh.make_outliers_table(df, iqrs=[1, 1.5, 3], up_or_down="both")
+    assert [(t.iqrs, t.up_or_down) for t in sweep] == [
+        (1, "up"), (1, "down"), (1.5, "up"), (1.5, "down"), (3, "up"), (3, "down")
+    ]
+    for table in sweep:
+        single = bsh.make_outliers_table(df, iqrs=table.iqrs, up_or_down=table.up_or_down)
+        assert single.df.equals(table.df)
+    assert len(bsh.compare_groups_outliers(sweep, annotations)) == len(sweep)
+
+
+def test_recall_outliers():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    stored = bsh.make_outliers_table(df)
+    assert list(stored.row_stats.index) == list(df.index)
+    for iqrs, up_or_down in [(1.5, "up"), (1, "up"), (2, "down")]:
+        recalled = bsh.recall_outliers(df, stored, iqrs=iqrs, up_or_down=up_or_down)
+        expected = bsh.make_outliers_table(df, iqrs=iqrs, up_or_down=up_or_down)
+        assert recalled.df.equals(expected.df)
+        assert recalled.row_stats.equals(expected.row_stats)
+
+
+def test_recall_outliers_from_file(tmp_path):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    prefix = str(tmp_path / "outliers")
+    stored = bsh.make_outliers_table(df, output_prefix=prefix, save_row_stats=True)
+    row_stats = bsh.read_in_row_stats(prefix + ".row_stats.tsv")
+    recalled = bsh.recall_outliers(df, row_stats, aggregate=False)
+    expected = bsh.make_outliers_table(df, aggregate=False)
+    assert recalled.df.equals(expected.df)
+    assert stored.row_stats.index.equals(row_stats.index)
+
+
+def test_outliers_table_float32():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    expected_outliers, expected_qvals = bsh.deva(df, annotations)
+    test_outliers, test_qvals = bsh.deva(df, annotations, dtype="float32")
+    assert test_outliers.outlier_counts.dtype == "uint8"
+    assert (test_outliers.frac_table.dtypes == "float32").all()
+    assert test_outliers.df.astype(float).equals(expected_outliers.df.astype(float))
+    assert test_qvals.df.equals(expected_qvals.df)
+
+
+def test_outliers_table_float32_n_jobs(tmp_path):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.normal(size=(5000, 6)).round(1),
+        index=["gene%s-%s" % (i // 4, i) for i in range(5000)],
+        columns=["s%s" % i for i in range(6)],
+    )
+    prefix = str(tmp_path / "outliers")
+    serial = bsh.make_outliers_table(
+        df, iqrs=0.5, aggregate=False, dtype="float32", output_prefix=prefix, save_row_stats=True
+    )
+    parallel = bsh.make_outliers_table(
+        df, iqrs=0.5, aggregate=False, dtype="float32", n_jobs=2
+    )
+    assert serial.df.equals(parallel.df)
+    row_stats = bsh.read_in_row_stats(prefix + ".row_stats.tsv")
+    recalled = bsh.recall_outliers(df, row_stats, iqrs=0.5, aggregate=False, dtype="float32")
+    assert serial.df.equals(recalled.df)
+
+
+def test_row_quantiles():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    values = df.to_numpy(dtype=float)
+    for table in (values, np.nan_to_num(values), np.full_like(values, np.nan)):
+        expected = np.nanquantile(table, [0.25, 0.5, 0.75], axis=1)
+        assert np.array_equal(np.array(_row_quantiles(table)), expected, equal_nan=True)
+
+
+def test_outliers_table_approximate():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    for up_or_down in ["up", "down"]:
+        exact = bsh.make_outliers_table(df, up_or_down=up_or_down, aggregate=False)
+        approx = bsh.make_outliers_table(
+            df, up_or_down=up_or_down, aggregate=False, approximate=True, sketch_size=8
+        )
+        changed = (exact.outlier_counts != approx.outlier_counts).sum(axis=1)
+        assert (changed <= approx.row_stats["row_uncertainCalls"].to_numpy()).all()
+        fine = bsh.make_outliers_table(
+            df, up_or_down=up_or_down, aggregate=False, approximate=True, sketch_size=100000
+        )
+        assert fine.row_stats["row_uncertainCalls"].sum() == 0
+        assert fine.df.equals(exact.df)
+
+
+def test_row_sketch():
+    rng = np.random.default_rng(0)
+    values = rng.standard_cauchy(size=(50, 3000))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    q1, median, q3 = _row_quantiles(values)
+    whole = _RowSketch(len(values), 256)
+    whole.update(values)
+    # Sketches of separate blocks of samples merge into a sketch of the whole table
+    merged = _RowSketch(len(values), 256)
+    merged.update(values[:, :1234])
+    other = _RowSketch(len(values), 256)
+    other.update(values[:, 1234:])
+    merged.merge(other)
+    for sketch in (whole, merged):
+        _, _, (median_low, median_high), (iqr_low, iqr_high) = sketch.row_stats()
+        assert ((median_low <= median) & (median <= median_high)).all()
+        assert ((iqr_low <= q3 - q1) & (q3 - q1 <= iqr_high)).all()
+        uncertain = _uncertain_calls(
+            values, (median_low, median_high), (iqr_low, iqr_high), 1.5, "up"
+        )
+        assert uncertain.sum() < 0.05 * (~np.isnan(values)).sum()
+    with pytest.raises(ValueError):
+        whole.merge(_RowSketch(len(values), 128))
+
+    # Rank errors only grow with the non-missing values of each row
+    values[:10, rng.random(3000) < 0.9] = np.nan
+    sparse = _RowSketch(len(values), 256)
+    sparse.update(values)
+    n = sparse.valid_counts
+    levels = np.floor(np.log2(np.maximum(n / (2 * 256), 1))) + (n >= 2 * 256)
+    assert (sparse.error <= n / (2 * 256) * levels).all()
+    assert (sparse.error[:10] < sparse.error[10:].min()).all()
+
+
+def test_numba_backend(monkeypatch):
+    pytest.importorskip("numba")
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    for aggregate in [True, False]:
+        numpy_outliers, numpy_qvals = bsh.deva(
+            df, annotations, aggregate=aggregate, backend="numpy"
+        )
+        monkeypatch.setenv("BLACKSHEEP_BACKEND", "numba")
+        numba_outliers, numba_qvals = bsh.deva(df, annotations, aggregate=aggregate)
+        monkeypatch.delenv("BLACKSHEEP_BACKEND")
+        assert numba_outliers.df.equals(numpy_outliers.df)
+        assert numba_outliers.row_stats.equals(numpy_outliers.row_stats)
+        assert numba_qvals.df.columns.equals(numpy_qvals.df.columns)
+        assert np.allclose(numba_qvals.df, numpy_qvals.df, rtol=1e-9, equal_nan=True)
+
+
+def test_outliers_table_packed_sites():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    sites = bsh.make_outliers_table(df, aggregate=False)
+    assert sites.packed
+    assert sites.outlier_bits.shape == (len(df), (len(df.columns) + 7) // 8)
+    group = list(df.columns[::3])
+    positions = pd.Index(sites.samples).get_indexer(group)
+    indicator = bsh.comparisons._group_indicator([group], sites.samples)
+    outlier_totals, valid_totals, outlier_samples = sites.indicator_totals(indicator)
+    assert (outlier_totals[:, 0] == sites.outlier_counts[:, positions].sum(axis=1)).all()
+    assert (valid_totals[:, 0] == sites.valid_counts[:, positions].sum(axis=1)).all()
+    assert (outlier_samples == outlier_totals).all()
+
+    unpacked = bsh.classes.OutlierTable(
+        sites.df, "up", 1.5, list(df.columns), None, aggregated=False
+    )
+    assert not unpacked.packed
+    assert bsh.compare_groups_outliers(sites, annotations).df.equals(
+        bsh.compare_groups_outliers(unpacked, annotations).df
+    )
+
+
+def test_outliers_table_array_input():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    expected = bsh.make_outliers_table(df)
+    values = df.to_numpy(dtype=float)
+    from_array = bsh.make_outliers_table(
+        values, row_labels=df.index, sample_labels=df.columns
+    )
+    assert from_array.df.equals(expected.df)
+    frame = bsh.parsers._as_values_frame(values, df.index, df.columns, "float64")
+    assert np.shares_memory(frame.to_numpy(dtype=float), values)
+
+
+def test_outliers_table_arrow_input():
+    pa = pytest.importorskip("pyarrow")
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = pa.Table.from_pandas(df.rename_axis("site").reset_index(), preserve_index=False)
+    from_arrow = bsh.make_outliers_table(table, row_labels="site")
+    assert from_arrow.df.equals(bsh.make_outliers_table(df).df)
+
+
+@pytest.mark.parametrize("aggregate", [True, False])
+def test_outliers_table_incremental(tmp_path, aggregate):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    prefix = str(tmp_path / "outliers")
+    kwargs = dict(
+        aggregate=aggregate, up_or_down="both", save_outlier_table=True, output_prefix=prefix,
+        incremental=True,
+    )
+    bsh.make_outliers_table(df, **kwargs)
+    changed = df.copy()
+    changed.iloc[:3] = changed.iloc[:3] * 2
+    changed = changed.drop(changed.index[-1])
+    updated = bsh.make_outliers_table(changed, **kwargs)
+    expected = bsh.make_outliers_table(changed, aggregate=aggregate, up_or_down="both")
+    for test, exp in zip(updated, expected):
+        assert test.df.astype(float).equals(exp.df.astype(float))
+        assert test.row_stats.equals(exp.row_stats)
+    with pytest.raises(ValueError):
+        bsh.make_outliers_table(df, incremental=True)
+
+
+@pytest.mark.parametrize("aggregate", [True, False])
+def test_ordered_outliers_table(aggregate):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    df.iloc[2, 3] = np.nan
+    last = df.columns[-1]
+    ordered = bsh.OrderedOutlierTable(df.drop(columns=last), aggregate=aggregate)
+    ordered.add_sample(last, df[last])
+    expected = bsh.make_outliers_table(df, aggregate=aggregate)
+    assert ordered.df.astype(float).equals(expected.df.astype(float))
+    assert ordered.row_stats.equals(expected.row_stats)
+
+    left_out = ordered.without_sample(df.columns[3])
+    ordered.remove_sample(df.columns[3])
+    expected = bsh.make_outliers_table(df.drop(columns=df.columns[3]), aggregate=aggregate)
+    for test in (ordered, left_out):
+        assert test.df.astype(float).equals(expected.df.astype(float))
+        assert test.row_stats.equals(expected.row_stats)
+
+
+def test_jackknife_qvalues():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    stability = bsh.jackknife_qvalues(df, annotations)
+    qvals = bsh.compare_groups_outliers(bsh.make_outliers_table(df), annotations).df
+    for col in qvals.columns:
+        assert stability[col].equals(qvals[col])
+        tested = qvals[col].notna()
+        assert (stability.loc[tested, "%s_jackknifeSE" % col] >= 0).all()
+        assert (stability.loc[~tested, "%s_jackknifeMax" % col].isna()).all()
+
+
+def test_fisher_exact():
+    scipy_stats = pytest.importorskip("scipy.stats")
+    rng = np.random.default_rng(0)
+    tables = rng.integers(0, 40, size=(500, 4))
+    tables[:50] = rng.integers(0, 2000, size=(50, 4))
+    tables[50:60, :2] = 0
+    expected = [scipy_stats.fisher_exact([[a, b], [c, d]])[1] for a, b, c, d in tables]
+    assert np.allclose(_fisher_exact(*tables.T), expected, rtol=1e-9, atol=0)
+
+
+def test_fisher_lookup():
+    rng = np.random.default_rng(0)
+    valid0 = np.where(rng.random(2000) < 0.9, 12, rng.integers(5, 13, 2000))
+    valid1 = np.full(2000, 20)
+    outliers0, outliers1 = rng.binomial(valid0, 0.3), rng.binomial(valid1, 0.1)
+    tables = (outliers0, outliers1, valid0 - outliers0, valid1 - outliers1)
+    assert np.allclose(_fisher_lookup(*tables), _fisher_exact(*tables), rtol=1e-12, atol=0)
+    assert (12, 20) in bsh._fisher._fisher_grids
+
+
+@pytest.mark.parametrize("aggregate", [True, False])
+def test_indicator_totals(aggregate):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df, aggregate=aggregate)
+    groups = [list(df.columns[::2]), list(df.columns[1::3]), list(df.columns[:4])]
+    indicator = bsh.comparisons._group_indicator(groups, table.samples)
+    all_totals = table.indicator_totals(indicator)
+    for position, group in enumerate(groups):
+        outlier_counts = table.outlier_counts[:, pd.Index(table.samples).get_indexer(group)]
+        expected = (
+            outlier_counts.sum(axis=1),
+            table.valid_counts[:, pd.Index(table.samples).get_indexer(group)].sum(axis=1),
+            (outlier_counts > 0).sum(axis=1),
+        )
+        for expected_totals, totals in zip(expected, all_totals):
+            assert (totals[:, position] == expected_totals).all()
+
+
+def test_indicator_totals_float_operands():
+    # Integer matrix products skip BLAS and are many times slower
+    rng = np.random.default_rng(0)
+    samples = ["s%d" % i for i in range(50)]
+    for scale, dtype in ((1, np.float32), (1 << 20, np.float64)):
+        valid_counts = rng.integers(1, 10, (30, 50)).astype(np.int64) * scale
+        outlier_counts = rng.integers(0, 10, (30, 50)) * (valid_counts // 10)
+        table = bsh.classes.OutlierTable(
+            None, "up", 1.5, samples, None,
+            outlier_counts=outlier_counts,
+            valid_counts=valid_counts,
+            index=pd.Index(["g%d" % i for i in range(30)]),
+            aggregated=True,
+        )
+        assert all(operand.dtype == dtype for operand in table._get_totals_operands())
+        indicator = bsh.comparisons._group_indicator([samples[::2], samples[1::3]], samples)
+        outlier_totals, valid_totals, _ = table.indicator_totals(indicator)
+        assert (valid_totals[:, 0] == valid_counts[:, ::2].sum(axis=1)).all()
+        assert (outlier_totals[:, 1] == outlier_counts[:, 1::3].sum(axis=1)).all()
+
+
+def test_run_comparisons_memory():
+    rng = np.random.default_rng(0)
+    peaks = []
+    for n_samples in (100, 1000):
+        samples = ["s%d" % i for i in range(n_samples)]
+        table = bsh.classes.OutlierTable(
+            None, "up", 1.5, samples, None,
+            outlier_counts=(rng.random((2000, n_samples)) < 0.1).astype(np.int32),
+            valid_counts=np.ones((2000, n_samples), dtype=np.int32),
+            index=pd.Index(["g%d" % i for i in range(2000)]),
+            aggregated=True,
+        )
+        comparisons = [
+            ("c%d" % c, ["a", "b"], [samples[c::2][:20], samples[c + 1::2][:20]])
+            for c in range(8)
+        ]
+        # Table-sized operands are built once per table, not once per block
+        bsh.comparisons._run_comparisons(table, comparisons[:1], None)
+        tracemalloc.start()
+        bsh.comparisons._run_comparisons(table, comparisons, None)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < 1.5 * peaks[0]
+    assert peaks[1] < table.outlier_counts.nbytes
+
+
+@pytest.mark.parametrize("aggregate", [True, False])
+def test_compare_groups_n_jobs(tmp_path, aggregate):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df, aggregate=aggregate)
+    expected = bsh.compare_groups_outliers(table, annotations)
+    prefix = str(tmp_path / "outliers")
+    test = bsh.compare_groups_outliers(
+        table, annotations, output_prefix=prefix, save_comparison_summaries=True, n_jobs=2
+    )
+    assert test.df.equals(expected.df)
+    assert list(test.df.columns) == list(expected.df.columns)
+
+
+def test_comparisons_worker_table():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df, aggregate=False, dtype="float32")
+    shms, specs = [], []
+    for array in (table.outlier_bits, table.valid_bits):
+        shm, shared_array, spec = bsh._parallel._create_shared_array(array.shape, array.dtype)
+        shared_array[...] = array
+        shms.append(shm)
+        specs.append(spec)
+        del shared_array
+    try:
+        bsh._parallel._init_comparisons_worker(
+            tuple(specs), True, list(table.samples), table.index, False, table.bits_dtype
+        )
+        worker = bsh._parallel._worker_outliers
+        assert worker.bits_dtype == table.bits_dtype == "uint8"
+        assert worker.outlier_counts.dtype == table.outlier_counts.dtype
+        assert worker.index.equals(table.index)
+        assert not worker.aggregated
+        del worker
+    finally:
+        bsh._parallel._worker_outliers = None
+        for shm in bsh._parallel._worker_shms + shms:
+            shm.close()
+        for shm in shms:
+            shm.unlink()
+        bsh._parallel._worker_shms.clear()
+
+
+def test_compare_groups_blocks(monkeypatch):
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df)
+    expected = bsh.compare_groups_outliers(table, annotations, frac_filter=None)
+    monkeypatch.setattr(bsh.comparisons, "totals_block_cells", 1)
+    test = bsh.compare_groups_outliers(table, annotations, frac_filter=None)
+    assert test.df.equals(expected.df)
+
+
+def test_compare_groups_permutation():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df)
+    fisher = bsh.compare_groups_outliers(table, annotations)
+    test = bsh.compare_groups_outliers(
+        table, annotations, test="permutation", n_permutations=200, seed=1
+    )
+    assert test.df.index.equals(fisher.df.index)
+    assert list(test.df.columns) == list(fisher.df.columns)
+    assert ((test.df >= 1 / 201) | test.df.isnull()).all().all()
+    again = bsh.compare_groups_outliers(
+        table, annotations, test="permutation", n_permutations=200, seed=1, n_jobs=2
+    )
+    assert again.df.equals(test.df)
+    with pytest.raises(ValueError):
+        bsh.compare_groups_outliers(table, annotations, test="t")
+    with pytest.raises(ValueError):
+        bsh.compare_groups_outliers(table, annotations, test="permutation", n_permutations=0)
+
+
+def test_permutation_pvalues():
+    rng = np.random.default_rng(0)
+    outlier_counts = np.array([[1] * 6 + [0] * 6, [0, 1] * 6])
+    valid_counts = np.ones((2, 12))
+    in_group0 = np.arange(12) < 6
+    pvalues, used = _permutation_pvalues(outlier_counts, valid_counts, in_group0, 2000, rng)
+    # 1 of the 924 ways to pick group0 puts every outlier in it
+    assert pvalues[0] < 0.01
+    assert used[0] == 2000
+    assert used[1] < 2000
+    assert pvalues[1] > 0.2
+
+
+def test_compare_groups_multilevel():
+    with open("tests/pidgin_example.pickle", "rb") as fh:
+        df, annotations, outliers, fractable, qvalues = pickle.load(fh)
+    table = bsh.make_outliers_table(df, aggregate=False)
+    subtypes = annotations[["comp0"]].assign(subtype=["A", "B", "C"] * 6)[["subtype", "comp0"]]
+    expected = bsh.compare_groups_outliers(
+        table, bsh.binarize_annotations(subtypes), frac_filter=0.1
+    )
+    test = bsh.compare_groups_outliers(table, subtypes, frac_filter=0.1)
+    assert "fisherFDR_subtype_A_not-A" in test.df.columns
+    assert list(test.comps) == ["subtype_A", "subtype_B", "subtype_C", "comp0"]
+    assert test.df.sort_index(axis=1).equals(expected.df.sort_index(axis=1))